@@ -39,8 +39,24 @@ class PlayerHistoryAdmin(admin.ModelAdmin):
 
 
 class PlayersUpdateAdmin(admin.ModelAdmin):
-    readonly_fields = ("last_update", "club_league_running")
-    list_display = ("last_update", "club_league_running")
+    readonly_fields = (
+        "last_update",
+        "club_league_running",
+        "last_club_league_day",
+        "min_last_updated",
+        "last_position",
+        "batches_done",
+        "players_updated",
+        "completed",
+        "shard_index",
+        "shard_count",
+    )
+    list_display = (
+        "last_update",
+        "club_league_running",
+        "players_updated",
+        "completed",
+    )
 
 
 class ClubAdmin(admin.ModelAdmin):
@@ -106,4 +122,5 @@ admin.site.register(models.BrawlMap, BrawlMapAdin)
 admin.site.register(models.Brawler, BrawlerAdmin)
 admin.site.register(models.Match, MatchAdmin)
 admin.site.register(models.MatchIssue, MatchIssueAdmin)
+admin.site.register(models.ClubLeagueCounters)
 admin.site.site_header = "Brawl Club Admin"
@@ -0,0 +1,44 @@
+"""Micro-benchmark of the battleTime parsing done for each club league battle.
+
+Run with: python -m player_lookup.benchmarks.battle_time
+"""
+import os
+import time
+import timeit
+
+import dateutil.parser
+
+from player_lookup.utils import parse_battle_time
+
+BATTLE_TIME = "20221130T125400.000Z"
+NUMBER = 100_000
+
+
+def dateutil_path(battle_time: str):
+    """How battle dates and match ids were computed before parse_battle_time."""
+    battle_date = dateutil.parser.parse(battle_time)
+    return battle_date, int(battle_date.strftime("%s"))
+
+
+def parse_battle_time_path(battle_time: str):
+    # Bypass the cache, battles are mostly different within a batch
+    return parse_battle_time.__wrapped__(battle_time)
+
+
+def main() -> None:
+    # Django runs in UTC, strftime("%s") uses the local timezone
+    os.environ["TZ"] = "UTC"
+    time.tzset()
+    assert dateutil_path(BATTLE_TIME) == parse_battle_time_path(BATTLE_TIME)
+
+    for name, function in (
+        ("dateutil + strftime", dateutil_path),
+        ("parse_battle_time (uncached)", parse_battle_time_path),
+        ("parse_battle_time (cached)", parse_battle_time),
+    ):
+        elapsed_time = timeit.timeit(lambda: function(BATTLE_TIME), number=NUMBER)
+        print(f"{name:<30} {elapsed_time / NUMBER * 1e6:8.2f} µs per battle")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,294 @@
 from __future__ import annotations
 import asyncio
+import logging
 import os
-from typing import Union
+import random
+import time
+import weakref
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from importlib.util import find_spec
+from typing import AsyncIterator, Dict, Union
 import requests
 import httpx
 
+from .rate_limiter import ApiKeyPool
+
+
+# Default throttling applied to each API key, can be overridden with the
+# BRAWLSTARS_API_RATE and BRAWLSTARS_API_BURST environment variables.
+DEFAULT_RATE = 10.0  # Requests per second
+DEFAULT_BURST = 20  # Requests that can be fired at once
+
+# Throttled (429) and unavailable (5xx) responses are retried with a jittered
+# exponential backoff, unless the API tells us how long to wait with Retry-After
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_RETRIES_PER_CALL = 5
+# A batch can spend at most this many retries per call it makes
+BATCH_RETRY_RATIO = 0.5
+BACKOFF_BASE_DELAY = 0.5  # Seconds
+BACKOFF_MAX_DELAY = 30  # Seconds
+
+# Connection pool shared by all the requests made from an event loop.
+# Connections are kept alive between batches so we don't pay a TLS handshake
+# for each request.
+CONNECTION_LIMITS = httpx.Limits(
+    max_connections=100, max_keepalive_connections=100, keepalive_expiry=60
+)
+# The rate limiter, not the pool, makes requests wait, hence no pool timeout
+CONNECTION_TIMEOUT = httpx.Timeout(30, pool=None)
+# Number of clubs whose members are fetched at the same time
+CLUB_BATCH_CONCURRENCY = 50
+
+logger = logging.getLogger("django")
+
+
+def get_setting_per_key(setting: str, number_of_keys: int) -> list:
+    """Split a #-separated setting so there is one value per API key.
+
+    A single value is applied to every key.
+    """
+    values = setting.split("#")
+    if len(values) == 1:
+        values = values * number_of_keys
+    if len(values) != number_of_keys:
+        raise ValueError(
+            f"Expected 1 or {number_of_keys} values, got {len(values)}: {setting}"
+        )
+    return values
+
+
+class RetryBudget:
+    """Bound the number of retries spent over a batch of API calls.
+
+    Keep a single budget for a whole batch, so a long API outage doesn't make
+    every call of the batch wait for its own retries.
+    """
+
+    def __init__(self, max_retries: int) -> None:
+        self.max_retries = max_retries
+        self.retries_used = 0
+
+    @classmethod
+    def for_batch(cls, number_of_calls: int) -> RetryBudget:
+        """Budget for a batch of calls, in proportion to its size."""
+        max_retries = max(
+            MAX_RETRIES_PER_CALL, int(number_of_calls * BATCH_RETRY_RATIO)
+        )
+        return cls(max_retries)
+
+    @property
+    def exhausted(self) -> bool:
+        return self.retries_used >= self.max_retries
+
+    def spend(self) -> None:
+        self.retries_used += 1
+
+
+def get_retry_delay(attempt: int, retry_after: Union[str, None]) -> float:
+    """Return the number of seconds to wait before retrying a request.
+
+    Keyword arguments:
+    attempt -- number of retries already made for this call
+    retry_after -- value of the Retry-After header, either seconds or an HTTP date
+    """
+    if retry_after:
+        try:
+            return min(BACKOFF_MAX_DELAY, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+        try:
+            retry_date = parsedate_to_datetime(retry_after)
+            delay = (retry_date - datetime.now(timezone.utc)).total_seconds()
+            return min(BACKOFF_MAX_DELAY, max(0.0, delay))
+        except (TypeError, ValueError):
+            pass
+
+    # Full jitter, so throttled calls don't all come back at the same time
+    return random.uniform(0, min(BACKOFF_MAX_DELAY, BACKOFF_BASE_DELAY * 2**attempt))
+
+
+def should_retry(
+    attempt: int,
+    response: Union[httpx.Response, requests.Response, None],
+    retry_budget: Union[RetryBudget, None],
+) -> bool:
+    """Tell whether a failed call (response is None) or a response is retried"""
+    if response is not None and response.status_code not in RETRY_STATUS_CODES:
+        return False
+    if attempt >= MAX_RETRIES_PER_CALL:
+        return False
+    if retry_budget is not None and retry_budget.exhausted:
+        return False
+    return True
+
 
 class BrawlAPi:
     def __init__(self) -> None:
         self.base_url = "https://api.brawlstars.com/v1/"
-        self._api_key = os.environ.get("BRAWLSTARS_API_KEY")
         # To use multiple API keys, separate them with a #
         # The need of multiple keys is to avoid being throttled.
         # Up to 10 keys are allowed per account.
-        self._api_key = iter(self._api_key.split("#"))
+        api_keys = os.environ.get("BRAWLSTARS_API_KEY").split("#")
+        # Rate and burst can be set for each key the same way, or once for all
+        rates = get_setting_per_key(
+            os.environ.get("BRAWLSTARS_API_RATE", str(DEFAULT_RATE)), len(api_keys)
+        )
+        bursts = get_setting_per_key(
+            os.environ.get("BRAWLSTARS_API_BURST", str(DEFAULT_BURST)), len(api_keys)
+        )
+        self._all_keys_pool = self.key_pool = ApiKeyPool(
+            api_keys,
+            [float(rate) for rate in rates],
+            [int(burst) for burst in bursts],
+        )
+        # HTTP/2 multiplexes the requests over a few connections, it requires
+        # the optional h2 package (pip install httpx[http2])
+        self.http2 = os.environ.get("BRAWLSTARS_API_HTTP2", "").lower() == "true"
+        if self.http2 and find_spec("h2") is None:
+            logger.warning("h2 is not installed, falling back to HTTP/1.1")
+            self.http2 = False
+        # An httpx client can only be used in the event loop it was created in,
+        # async_to_sync creates a new loop on each call outside of a running one.
+        self._clients = weakref.WeakKeyDictionary()
+
+    def use_shard(self, shard_index: int, shard_count: int) -> None:
+        """Only use this worker's share of the API keys, see ApiKeyPool.shard"""
+        self.key_pool = self._all_keys_pool.shard(shard_index, shard_count)
+
+    def get_client(self) -> httpx.AsyncClient:
+        """Return the pooled client of the running event loop, open it if needed."""
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                limits=CONNECTION_LIMITS,
+                timeout=CONNECTION_TIMEOUT,
+                http2=self.http2,
+            )
+            self._clients[loop] = client
+        return client
+
+    async def aclose(self) -> None:
+        """Close the pooled client of the running event loop."""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[httpx.AsyncClient]:
+        """Keep the pooled client open for the duration of the context.
+
+        Sessions can be nested, the client is closed when leaving the outermost
+        one. Wrap a whole command in a session so every batch reuses the same
+        connections.
+        """
+        already_open = asyncio.get_running_loop() in self._clients
+        client = self.get_client()
+        try:
+            yield client
+        finally:
+            if not already_open:
+                await self.aclose()
 
     @property
     def api_key(self) -> str:
-        try:
-            return next(self._api_key)
-        except StopIteration:
-            self.__init__()
-            return next(self._api_key)
+        """Wait for the least loaded API key to be available and return it."""
+        return self.key_pool.acquire_sync()
 
     @property
     def headers(self) -> dict:
+        """Headers for a synchronous request, blocks until a key is available."""
+        return self.build_headers(self.api_key)
+
+    async def get_headers(self) -> dict:
+        """Headers for an asynchronous request, waits until a key is available."""
+        api_key = await self.key_pool.acquire()
+        return self.build_headers(api_key)
+
+    def build_headers(self, api_key: str) -> dict:
         header = {
-            "Authorization": f"Bearer {self.api_key}",
+            "Authorization": f"Bearer {api_key}",
             "Accept": "application/json",
         }
         return header
 
+    async def get(
+        self, url: str, retry_budget: Union[RetryBudget, None] = None
+    ) -> httpx.Response:
+        """Throttled GET request to the Brawl Stars API, using the pooled client.
+
+        Throttled and failed requests are retried, up to MAX_RETRIES_PER_CALL
+        times and as long as the retry budget isn't exhausted. The last response
+        is returned if all retries failed.
+        """
+        client = self.get_client()
+        attempt = 0
+        while True:
+            headers = await self.get_headers()
+            try:
+                response = await client.get(url, headers=headers)
+            except httpx.TransportError:
+                if not should_retry(attempt, None, retry_budget):
+                    raise
+                response = None
+            if not should_retry(attempt, response, retry_budget):
+                return response
+
+            retry_after = (
+                response.headers.get("Retry-After") if response is not None else None
+            )
+            delay = get_retry_delay(attempt, retry_after)
+            logger.info(f"Request to {url} failed, retrying in {delay:.2f}s")
+            if retry_budget is not None:
+                retry_budget.spend()
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def get_json(
+        self, url: str, retry_budget: Union[RetryBudget, None] = None
+    ) -> dict:
+        """GET request returning the JSON payload of the response.
+
+        A call that still fails after all its retries (network error, body that
+        isn't JSON, e.g. from a proxy) gives an error payload with a reason, as
+        the API does, instead of raising. A single failed call doesn't abort
+        the batch it's gathered with.
+        """
+        try:
+            response = await self.get(url, retry_budget)
+            return response.json()
+        except (httpx.TransportError, ValueError) as error:
+            # ValueError: the response isn't JSON
+            logger.info(f"Request to {url} failed ({error!r})")
+            return {"reason": type(error).__name__}
+
+    def get_sync(
+        self, url: str, retry_budget: Union[RetryBudget, None] = None
+    ) -> requests.Response:
+        """Blocking version of get, for the requests made outside an event loop"""
+        attempt = 0
+        while True:
+            try:
+                response = requests.get(url, headers=self.headers)
+            except (requests.ConnectionError, requests.Timeout):
+                if not should_retry(attempt, None, retry_budget):
+                    raise
+                response = None
+            if not should_retry(attempt, response, retry_budget):
+                return response
+
+            retry_after = (
+                response.headers.get("Retry-After") if response is not None else None
+            )
+            delay = get_retry_delay(attempt, retry_after)
+            logger.info(f"Request to {url} failed, retrying in {delay:.2f}s")
+            if retry_budget is not None:
+                retry_budget.spend()
+            attempt += 1
+            time.sleep(delay)
+
     def get_player_stats_url(self, player_tag: str) -> str:
         if player_tag.startswith("#"):
             # We remove the # from the player tag
@@ -38,13 +296,10 @@ class BrawlAPi:
         url = f"{self.base_url}players/%23{player_tag}"
         return url
 
-    def get_player_battlelog(self, player_tag: str, client=httpx.AsyncClient()) -> dict:
+    def get_player_battlelog(self, player_tag: str) -> dict:
         """Get data from the player's last 24 matches"""
-        if player_tag.startswith("#"):
-            # We remove the # from the player tag
-            player_tag = player_tag[1:]
-        url = f"{self.base_url}players/%23{player_tag}/battlelog"
-        response = client.get(url, headers=self.headers)
+        url = self.get_player_battlelog_url(player_tag)
+        response = self.get_sync(url)
         return response.json()
 
     def get_player_battlelog_url(self, player_tag: str) -> str:
@@ -54,26 +309,27 @@ class BrawlAPi:
         url = f"{self.base_url}players/%23{player_tag}/battlelog"
         return url
 
-    async def get_club_members(self, club_tag: str, client=httpx.AsyncClient()) -> dict:
+    async def get_club_members(
+        self, club_tag: str, retry_budget: Union[RetryBudget, None] = None
+    ) -> dict:
         if club_tag.startswith("#"):
             # We remove the # from the club tag
             club_tag = club_tag[1:]
         url = f"{self.base_url}clubs/%23{club_tag}/members"
-        response = await client.get(url, headers=self.headers)
-        return response.json()
+        return await self.get_json(url, retry_budget)
 
-    async def get_club_members_tag_list(
-        self, club_tag: str, client=httpx.AsyncClient()
-    ) -> list:
-        """Returns a list of the club members' tags."""
-        api_calls = []
-        response = self.get_club_members(club_tag, client)
-        api_calls.append(response)
-        responses = await asyncio.gather(*api_calls)
+    async def get_club_members_tag_list(self, club_tag: str) -> list:
+        """Returns a list of the club members' tags, empty if they can't be
+        fetched."""
+        club_members = await self.get_club_members(club_tag)
+        if "items" not in club_members:
+            logger.info(
+                f"{club_tag}: Members unavailable ({club_members.get('reason')})"
+            )
+            return []
         club_members_tag_list = []
-        for club_members in responses:
-            for member in club_members["items"]:
-                club_members_tag_list.append(member["tag"])
+        for member in club_members["items"]:
+            club_members_tag_list.append(member["tag"])
         return club_members_tag_list
 
     def get_club_information(self, club_tag: str) -> dict:
@@ -81,28 +337,46 @@ class BrawlAPi:
             # We remove the # from the club tag
             club_tag = club_tag[1:]
         url = f"{self.base_url}clubs/%23{club_tag}"
-        response = requests.get(url, headers=self.headers)
+        response = self.get_sync(url)
         return response.json()
 
-    async def get_club_batch_player_tags_list(self, club_tags: list):
-        """Returns a list of the clubs members' tags."""
-        club_members_tag_list = []
-        api_calls = []
-        # We fetch all clubs members' tags, for each club in club_tags
-        async with httpx.AsyncClient(timeout=None) as client:
-            for club_tag in club_tags:
-                response = self.get_club_members(club_tag, client)
-                api_calls.append(response)
-            responses = await asyncio.gather(*api_calls)
-
-        # 1 api call = 1 club
-        # Each response is a dict with an "items" key, which is a list where each
-        # element is a dict with a "tag" key, which is the player tag.
-        for response in responses:
-            for member in response["items"]:
-                club_members_tag_list.append(member["tag"])
+    async def get_club_batch_members(
+        self, club_tags: list, concurrency: int = CLUB_BATCH_CONCURRENCY
+    ) -> Dict[str, list]:
+        """Returns the members of each club, as given by the API.
 
-        return club_members_tag_list
+        At most `concurrency` clubs are fetched at once. A club whose members
+        can't be fetched (not found, still throttled after all retries,
+        network error) is left out, the rest of the batch is kept.
+
+        Returns: a dict matching each club tag with its list of members, each
+        member being a dict with the tag, name, role and trophies of a player.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        retry_budget = RetryBudget.for_batch(len(club_tags))
+
+        async def get_members(club_tag: str) -> Union[list, None]:
+            async with semaphore:
+                response = await self.get_club_members(club_tag, retry_budget)
+            if "items" not in response:
+                logger.info(
+                    f"{club_tag}: Members unavailable ({response.get('reason')})"
+                )
+                return None
+            return response["items"]
+
+        async with self.session():
+            responses = await asyncio.gather(
+                *(get_members(club_tag) for club_tag in club_tags)
+            )
+        if retry_budget.retries_used:
+            logger.info(f"{retry_budget.retries_used} retries used to fetch members")
+
+        return {
+            club_tag: members
+            for club_tag, members in zip(club_tags, responses)
+            if members is not None
+        }
 
     def is_player_or_club(self, tag: str) -> Union[str, None]:
         """Returns wheter or not a tag represents a player or club or none of these
@@ -122,12 +396,12 @@ class BrawlAPi:
 
         # Battlelog will return 404 if the player hasn't played in a long time
         url = f"{self.base_url}players/%23{tag}/battlelog"
-        response = requests.get(url, headers=self.headers)
+        response = self.get_sync(url)
         if response.status_code == 200:
             return "player"
 
         url = f"{self.base_url}clubs/%23{tag}"
-        response = requests.get(url, headers=self.headers)
+        response = self.get_sync(url)
         if response.status_code == 200:
             return "club"
 
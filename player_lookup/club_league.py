@@ -0,0 +1,200 @@
+import threading
+from datetime import date, timedelta
+from typing import List, NamedTuple, Union
+
+# Club league weeks are indexed by their Wednesday, counted from this one
+CALENDAR_FIRST_WEDNESDAY = date(1970, 1, 7)
+# When the calendar is extended, it is extended this far after the queried day,
+# so it is only extended once in a while
+CALENDAR_EXTENSION = timedelta(weeks=52)
+
+
+def is_club_league_day(_date: date) -> bool:
+    """Tell whether tickets can be spent on a day.
+
+    Club league goes from Wednesday of an odd week to Monday of the next week.
+    """
+    week_number = _date.isocalendar()[1]
+    return (week_number % 2 != 0 and _date.weekday() not in (0, 1)) or (
+        week_number % 2 == 0 and _date.weekday() == 0
+    )
+
+
+class TicketSchedule(NamedTuple):
+    """Tickets of a club league day, see get_ticket_schedule."""
+
+    # Tickets granted since the start of the week's club league
+    this_weeks_available_tickets: int
+    # Tickets that can still be spent until the end of the week's club league
+    this_weeks_remaining_tickets: int
+    # Tickets that can be spent until the next tickets are granted
+    today_remaining_tickets: int
+    # Day the tickets that can be spent today were granted
+    club_league_day_start: Union[date, None]
+
+
+NO_TICKETS = TicketSchedule(0, 0, 0, None)
+
+# Club league goes from day 2 (Wednesday) to day 0 (Monday) the next week.
+# This means that the only day that has no club war going anywhere is Tuesday.
+# weekday -> (available, remaining and today's tickets, days since the tickets
+# of the day were granted)
+_WEEKDAY_SCHEDULES = {
+    # Wednesday, Thursday
+    2: (4, 14, 4, 0),
+    3: (4, 14, 4, 1),
+    # Friday, Saturday
+    # We lost the 4 tickets from wednesday
+    4: (8, 10, 4, 0),
+    5: (8, 10, 4, 1),
+    # Sunday, Monday
+    # We lost the 4 tickets from wednesday and the 4 tickets from friday
+    6: (14, 6, 6, 0),
+    0: (14, 6, 6, 1),
+}
+
+
+def get_ticket_schedule(day: date) -> TicketSchedule:
+    """Return the tickets of a day, assuming club league is running.
+
+    Every other week, one has 14 tickets to spend, from wednesday to monday.
+
+    On wednesday, 4 tickets are granted out of 14 tickets. If they aren't used
+    before Friday, they are lost.
+    On Friday, 4 more tickets are granted. If they aren't used before Sunday, they
+    are lost.
+    On Sunday, 6 tickets are granted. If they aren't used before Tuesday, they are
+    lost.
+
+    Args:
+        day (date): The day, in UTC.
+    """
+    weekday_schedule = _WEEKDAY_SCHEDULES.get(day.weekday())
+    if weekday_schedule is None:
+        return NO_TICKETS
+    available, remaining, today_remaining, days_since_grant = weekday_schedule
+    return TicketSchedule(
+        available, remaining, today_remaining, day - timedelta(days=days_since_grant)
+    )
+
+
+class ClubLeagueCalendar:
+    """Precomputed club league calendar, answering queries in O(1).
+
+    For each day since its first Wednesday, the calendar stores whether club
+    league is running, along with cumulative counts of the club league days
+    and of the club league weeks, so counting them between two days is a
+    subtraction. Days are UTC days. The tickets of a day are given by
+    get_ticket_schedule.
+
+    The calendar is extended when a day after its end is queried. Extending it
+    is done under a lock, and the lists are only appended to, so a single
+    calendar can be shared by the threads of the server.
+    """
+
+    def __init__(self, first_wednesday: date = CALENDAR_FIRST_WEDNESDAY) -> None:
+        if first_wednesday.weekday() != 2:
+            raise ValueError(f"{first_wednesday} is not a Wednesday")
+        self.first_wednesday = first_wednesday
+        self._lock = threading.Lock()
+        # _running[i] tells whether club league runs on the i-th day
+        self._running: List[bool] = []
+        # _running_days[i] counts the club league days during the i first days
+        self._running_days = [0]
+        # _club_league_weeks[i] counts the club league weeks starting on the i
+        # first Wednesdays
+        self._club_league_weeks = [0]
+
+    @property
+    def last_day(self) -> Union[date, None]:
+        """Last day computed so far, None before the first query."""
+        if not self._running:
+            return None
+        return self.first_wednesday + timedelta(days=len(self._running) - 1)
+
+    def _extend_week(self) -> None:
+        """Compute the week following the last computed day."""
+        wednesday = self.first_wednesday + timedelta(days=len(self._running))
+        days = [wednesday + timedelta(days=offset) for offset in range(7)]
+        running = [is_club_league_day(day) for day in days]
+        # A week counts when at least 5 of its days, from Wednesday to Monday,
+        # are club league days
+        self._club_league_weeks.append(
+            self._club_league_weeks[-1] + (sum(running[:6]) >= 5)
+        )
+        for day_running in running:
+            self._running_days.append(self._running_days[-1] + day_running)
+            # Appended last, the length of _running tells which days are ready
+            self._running.append(day_running)
+
+    def _get_index(self, day: date) -> int:
+        """Return the index of a day, extending the calendar to cover it."""
+        index = (day - self.first_wednesday).days
+        if index < 0:
+            raise ValueError(f"{day} is before the calendar's first day")
+        if index >= len(self._running):
+            with self._lock:
+                last_index = index + CALENDAR_EXTENSION.days
+                while last_index >= len(self._running):
+                    self._extend_week()
+        return index
+
+    def is_running(self, day: date) -> bool:
+        """Tell whether tickets can be spent on a day."""
+        return self._running[self._get_index(day)]
+
+    def count_club_league_days(self, first_day: date, last_day: date) -> int:
+        """Number of club league days between two days, both included."""
+        if last_day < first_day:
+            return 0
+        first_index = self._get_index(first_day)
+        last_index = self._get_index(last_day)
+        return self._running_days[last_index + 1] - self._running_days[first_index]
+
+    def count_club_league_weeks(
+        self, first_wednesday: date, last_wednesday: date
+    ) -> int:
+        """Number of club league weeks starting on Wednesdays between two
+        Wednesdays, both included."""
+        if last_wednesday < first_wednesday:
+            return 0
+        first_week = self._get_index(first_wednesday) // 7
+        last_week = self._get_index(last_wednesday) // 7
+        return (
+            self._club_league_weeks[last_week + 1] - self._club_league_weeks[first_week]
+        )
+
+    def get_number_of_weeks_between(self, first_day: date, last_day: date) -> int:
+        """Number of whole club league weeks between two days, both included.
+
+        Days are grouped in weeks ending on Tuesday. A week counts when 5 of its
+        days or more are club league days. The week of first_day only has the
+        days from first_day on, the week of last_day only counts if it ends on
+        last_day.
+        """
+        # Tuesday ending the week of the first day
+        first_tuesday = first_day + timedelta(days=(1 - first_day.weekday()) % 7)
+        if first_tuesday > last_day:
+            return 0
+
+        # The first week can be incomplete
+        club_league_days = self.count_club_league_days(
+            first_day, first_tuesday - timedelta(days=1)
+        )
+        number_of_weeks = int(club_league_days >= 5)
+
+        # Complete weeks, from Wednesday to the next Tuesday
+        number_of_complete_weeks = (last_day - first_tuesday).days // 7
+        if number_of_complete_weeks:
+            first_wednesday = first_tuesday + timedelta(days=1)
+            last_wednesday = first_wednesday + timedelta(
+                weeks=number_of_complete_weeks - 1
+            )
+            number_of_weeks += self.count_club_league_weeks(
+                first_wednesday, last_wednesday
+            )
+        return number_of_weeks
+
+
+# Calendar shared by the commands and the views of a process
+club_league_calendar = ClubLeagueCalendar()
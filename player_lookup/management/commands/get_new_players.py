@@ -1,60 +1,63 @@
 import logging
 from django.core.management.base import BaseCommand
-from player_lookup.models import Player, Club
+from player_lookup.models import Club
+from player_lookup.update_services import save_club_members
+from player_lookup.utils import keyset_batches
 from player_lookup.views import brawl_api
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 
 logger = logging.getLogger("django")
 
+# Number of clubs whose members are fetched at once
+CLUB_BATCH_SIZE = 999
+
 
 class Command(BaseCommand):
     help = """Create Player records for all clubs in database
 
     This command will create a Player record for each player in each club in the
-    database.
-    To the difference of update_all_players, this command will not update existing
-    records, but simply create blank Player instance that another command will fill.
+    database, with the name, trophies and club given by the club's member list.
+    To the difference of update_all_players, this command only updates these
+    fields and the club membership of existing records, the other stats are left
+    to update_all_players.
     """
 
     def handle(self, *args, **options):
         logger.info("Starting get_new_players command")
-        self.all_club_tags = Club.objects.values_list("club_tag", flat=True)
-        club_count = len(self.all_club_tags)
+        club_count = Club.objects.count()
         logger.info(f"Creating Player records for {club_count} clubs")
-        batch_size = 999
-        number_of_batches = club_count // batch_size * batch_size
-        first_loop = True
-        for i in range(0, number_of_batches + batch_size + 1, batch_size):
-            if first_loop:
-                first_loop = False
-                start = i
-                continue
-            logger.info(f"Creating Player records for clubs {start} to {i}")
-            tag_list = self.fetch_player_tag_list(self.all_club_tags[start:i])
-            start = i
-            self.create_player_records(tag_list)
+        self.create_all_player_records(CLUB_BATCH_SIZE)
 
     @async_to_sync
-    async def fetch_player_tag_list(self, club_tag_list: list) -> list:
-        """Fetch player tag list from API for each club in list
-
-        Keyword arguments:
-        club_tag_list -- list of club tags to fetch player tag list from BS API
-        """
-        return await brawl_api.get_club_batch_player_tags_list(club_tag_list)
+    async def create_all_player_records(self, batch_size: int) -> None:
+        """Fetch the members of every club, batch by batch, and create their records
 
-    def create_player_records(self, tag_list: list):
-        """Create Player records for each tag in tag_list if player doesn't exist
+        All batches are fetched within the same API session so they share the
+        same connection pool. The clubs are read batch by batch with keyset
+        pagination on their tag.
 
         Keyword arguments:
-        tag_list -- list of player tags to create Player records for
+        batch_size -- number of clubs fetched at once from BS API
         """
-        players_to_create = []
-        for tag in tag_list:
-            if not Player.objects.filter(player_tag=tag).exists():
-                players_to_create.append(
-                    Player(player_tag=tag, player_name="Not Fetched Yet")
+        club_tag_batches = keyset_batches(Club.objects.all(), ["club_tag"], batch_size)
+        clubs_done = 0
+        async with brawl_api.session():
+            while True:
+                club_tag_batch = await sync_to_async(next)(club_tag_batches, None)
+                if club_tag_batch is None:
+                    break
+                rows, _ = club_tag_batch
+                club_tag_list = [club_tag for club_tag, in rows]
+                logger.info(
+                    f"Creating Player records for clubs {clubs_done} to"
+                    f" {clubs_done + len(club_tag_list)}"
+                )
+                club_members = await brawl_api.get_club_batch_members(club_tag_list)
+                clubs_done += len(club_tag_list)
+                created, updated, left = await sync_to_async(save_club_members)(
+                    club_members
+                )
+                logger.info(
+                    f"Created {created} and updated {updated} Player records,"
+                    f" {left} players left their club"
                 )
-
-        logger.info(f"Creating {len(players_to_create)} Player records")
-        Player.objects.bulk_create(players_to_create)
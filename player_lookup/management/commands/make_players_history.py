@@ -1,39 +1,102 @@
 import logging
+from datetime import datetime, timezone
+
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
 from player_lookup.models import Player, PlayerHistory
+from player_lookup.utils import keyset_batches
 
 logger = logging.getLogger("django")
 
+# Fields copied from Player to PlayerHistory, they have the same name in both
+HISTORY_FIELDS = (
+    "trophy_count",
+    "total_club_war_trophy_count",
+    "brawlclub_rating",
+    "club_league_playrate",
+    "club_league_winrate",
+    "club_league_teamplay_rate",
+)
+
+
+def get_snapshot_sql(player_tag_range: bool = True) -> str:
+    """Return the INSERT ... SELECT copying the players into their history.
+
+    Its first parameter is the snapshot date. With player_tag_range, only the
+    players between two player tags, both included, are copied, the next two
+    parameters.
+    """
+    quote_name = connection.ops.quote_name
+
+    def column(model, field_name: str) -> str:
+        return quote_name(model._meta.get_field(field_name).column)
+
+    history_columns = [column(PlayerHistory, "player")] + [
+        column(PlayerHistory, field) for field in HISTORY_FIELDS
+    ]
+    history_columns.append(column(PlayerHistory, "snapshot_date"))
+    player_tag = column(Player, "player_tag")
+    player_columns = [player_tag] + [column(Player, field) for field in HISTORY_FIELDS]
+    player_columns.append("%s")
+    sql = (
+        f"INSERT INTO {quote_name(PlayerHistory._meta.db_table)}"
+        f" ({', '.join(history_columns)})"
+        f" SELECT {', '.join(player_columns)}"
+        f" FROM {quote_name(Player._meta.db_table)}"
+    )
+    if player_tag_range:
+        sql += f" WHERE {player_tag} >= %s AND {player_tag} <= %s"
+    return sql
+
 
 class Command(BaseCommand):
     help = "Create players history records"
 
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help=(
+                "Number of players copied by each INSERT ... SELECT, 0 to copy"
+                " them all with a single statement"
+            ),
+        )
+        return super().add_arguments(parser)
+
     def handle(self, *args, **options):
+        batch_size = options["batch_size"]
         player_count = Player.objects.count()
-
         logger.info(f"About to create {player_count} player history records.")
-        batch_size = 999
-        top_limit = player_count // batch_size * batch_size
-        first_loop = True
-        for i in range(0, top_limit + batch_size + 1, batch_size):
-            if first_loop:
-                first_loop = False
-                new_start = i
-                continue
-
-            logger.info(f"Updating row {new_start} to {i}")
-            player_batch = Player.objects.all()[new_start:i]
-            self.create_records(player_batch)
-            new_start = i
 
-        self.stdout.write(
-            self.style.SUCCESS("Successfully created all records"), ending="\n"
+        # The players are copied by the database, they don't go through the
+        # ORM. Every record of the snapshot has the same date, and the
+        # snapshot is saved as a whole or not at all.
+        snapshot_date = connection.ops.adapt_datetimefield_value(
+            datetime.now(timezone.utc)
         )
+        created = 0
+        with transaction.atomic(), connection.cursor() as cursor:
+            if batch_size:
+                # Each statement copies a range of player tags, read by keyset
+                # pagination on the primary key
+                snapshot_sql = get_snapshot_sql()
+                batches = keyset_batches(
+                    Player.objects.all(), ["player_tag"], batch_size
+                )
+                for batch, (last_player_tag,) in batches:
+                    (first_player_tag,) = batch[0]
+                    cursor.execute(
+                        snapshot_sql, [snapshot_date, first_player_tag, last_player_tag]
+                    )
+                    created += cursor.rowcount
+                    logger.info(f"Created {created} player history records")
+            else:
+                cursor.execute(
+                    get_snapshot_sql(player_tag_range=False), [snapshot_date]
+                )
+                created = cursor.rowcount
 
-    def create_records(self, player_batch):
-        records_batch = []
-        player: Player
-        for player in player_batch:
-            records_batch.append(player.create_player_history_instance())
-
-        PlayerHistory.objects.bulk_create(records_batch)
+        self.stdout.write(
+            self.style.SUCCESS(f"Successfully created {created} records"), ending="\n"
+        )
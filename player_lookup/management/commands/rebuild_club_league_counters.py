@@ -0,0 +1,48 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from player_lookup.models import Player, rebuild_club_league_counters
+
+logger = logging.getLogger("django")
+
+
+class Command(BaseCommand):
+    help = (
+        "Count the club league matches of every player from their match issues,"
+        " to reconcile the counters the ratings are computed from"
+    )
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of players whose counters are rebuilt at once",
+        )
+        return super().add_arguments(parser)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        total = Player.objects.count()
+        logger.info(f"Rebuilding the club league counters of {total} players...")
+
+        done = 0
+        last_player_tag = ""
+        while True:
+            # Keyset pagination on the primary key
+            players = list(
+                Player.objects.filter(player_tag__gt=last_player_tag)
+                .order_by("player_tag")
+                .only("player_tag", "default_date")[:batch_size]
+            )
+            if not players:
+                break
+            last_player_tag = players[-1].player_tag
+            rebuild_club_league_counters(players)
+            done += len(players)
+            logger.info(f"Rebuilt the counters of {done}/{total} players")
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Rebuilt the club league counters of {done} players"),
+            ending="\n",
+        )
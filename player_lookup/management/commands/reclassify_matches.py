@@ -0,0 +1,132 @@
+import logging
+from collections import Counter
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from player_lookup.match_types import (
+    NORMAL_MATCH,
+    POWER_MATCH,
+    get_match_types,
+)
+from player_lookup.models import (
+    Match,
+    MatchIssue,
+    Player,
+    rebuild_club_league_counters,
+)
+from player_lookup.utils import chunks
+
+logger = logging.getLogger("django")
+
+
+class Command(BaseCommand):
+    help = (
+        "Reclassify the type of every match and match issue from their outcome"
+        " and trophies won, after MATCH_TYPES changed"
+    )
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="Number of match issues classified at once",
+        )
+        return super().add_arguments(parser)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        total = MatchIssue.objects.count()
+        logger.info(f"Reclassifying {total} match issues...")
+
+        done = 0
+        updated_match_issues = 0
+        updated_matches = 0
+        unknown = Counter()
+        # Players whose club league counters count matches that changed type
+        affected_players = set()
+        last_id = 0
+        while True:
+            # Keyset pagination on the primary key
+            rows = list(
+                MatchIssue.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list(
+                    "id",
+                    "match_id",
+                    "outcome",
+                    "trophies_won",
+                    "played_with_clubmate",
+                    "match__battle_type",
+                )[:batch_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            ids, match_ids, outcomes, trophies_won, with_clubmate, battle_types = (
+                np.array(column) for column in zip(*rows)
+            )
+            (
+                known,
+                is_power_match,
+                played_with_clubmate,
+            ) = get_match_types(outcomes, trophies_won)
+            unknown.update(zip(outcomes[~known], trophies_won[~known].tolist()))
+
+            # Only rows whose type changed are updated, a query per new value
+            changed = known & (played_with_clubmate != with_clubmate.astype(bool))
+            for value in (True, False):
+                updated_match_issues += MatchIssue.objects.filter(
+                    id__in=ids[changed & (played_with_clubmate == value)].tolist()
+                ).update(played_with_clubmate=value)
+            affected_players.update(
+                MatchIssue.objects.filter(id__in=ids[changed].tolist()).values_list(
+                    "player_id", flat=True
+                )
+            )
+
+            new_battle_types = np.where(is_power_match, POWER_MATCH, NORMAL_MATCH)
+            changed = known & (new_battle_types != battle_types)
+            for battle_type in (POWER_MATCH, NORMAL_MATCH):
+                updated_matches += Match.objects.filter(
+                    match_id__in=set(
+                        match_ids[changed & (new_battle_types == battle_type)]
+                    )
+                ).update(battle_type=battle_type)
+            # Every player of a match counts its type, including those of the
+            # match issues of other batches
+            affected_players.update(
+                MatchIssue.objects.filter(
+                    match_id__in=set(match_ids[changed])
+                ).values_list("player_id", flat=True)
+            )
+
+            done += len(rows)
+            logger.info(f"Reclassified {done}/{total} match issues")
+
+        # The counters of the other players are still right, those of players
+        # without counters are built when first read
+        affected_players = sorted(affected_players)
+        rebuilt = 0
+        for player_tags in chunks(affected_players, batch_size):
+            players = list(
+                Player.objects.filter(
+                    player_tag__in=player_tags, club_league_counters__isnull=False
+                ).only("player_tag", "default_date")
+            )
+            rebuild_club_league_counters(players)
+            rebuilt += len(players)
+        logger.info(f"Rebuilt the club league counters of {rebuilt} players")
+
+        if unknown:
+            logger.warning(
+                "Unknown match types (outcome, trophies won), left as is:"
+                f" {dict(unknown)}"
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Updated {updated_match_issues} match issues"
+                f" and {updated_matches} matches"
+            ),
+            ending="\n",
+        )
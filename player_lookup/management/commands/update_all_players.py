@@ -1,9 +1,9 @@
+import argparse
 import asyncio
 from datetime import datetime, timedelta, timezone
 import logging
 import time
-import httpx
-from typing import Tuple
+from typing import Iterator, Tuple, Union
 from django.core.management.base import BaseCommand
 from django.db.models import Q, QuerySet
 from asgiref.sync import sync_to_async, async_to_sync
@@ -11,25 +11,45 @@ from player_lookup.models import (
     BrawlMap,
     Brawler,
     Club,
-    MatchIssue,
     Player,
     PlayersUpdate,
 )
 from player_lookup.models import update_player_batch_remaining_tickets
 from player_lookup.views import brawl_api
+from player_lookup.brawlstars_api import RetryBudget
+from player_lookup.match_types import UNKNOWN_MATCH, unknown_match_types
+from player_lookup.ratings import update_batch_brawlclub_ratings
+from player_lookup.run_lock import ShardedRunLock
 from player_lookup.update_services import (
+    MatchRegistry,
+    NameIndex,
     create_matches_from_battlelog,
-    get_player_data,
-    get_player_battlelog,
-)
-from player_lookup.utils import (
-    get_club_league_status,
-    get_last_club_league_day_start,
-    get_today_number_of_remaining_tickets,
+    get_battlelogs_names,
+    get_player_profile_and_battlelog,
 )
+from player_lookup import utils
+from player_lookup.utils import get_shard_index, keyset_batches
 
 logger = logging.getLogger("django")
 
+# Number of batches fetched from the API that can wait to be saved
+FETCHED_BATCHES_QUEUE_SIZE = 1
+# Best rated players are updated first, player_tag makes the ordering unique
+UPDATE_ORDERING = ("-brawlclub_rating", "last_updated", "player_tag")
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse the --shard option, e.g. 0/4 for the first of 4 shards."""
+    try:
+        shard_index, shard_count = (int(number) for number in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected i/N, got {value}")
+    if not 0 <= shard_index < shard_count:
+        raise argparse.ArgumentTypeError(
+            f"Shard index must be between 0 and {shard_count - 1}, got {value}"
+        )
+    return shard_index, shard_count
+
 
 class Command(BaseCommand):
     help = "Update every player in the database"
@@ -41,13 +61,61 @@ class Command(BaseCommand):
             action="store_true",
             help="Force update of all players",
         )
+        parser.add_argument(
+            "--resume",
+            "-r",
+            action="store_true",
+            help="Resume the last interrupted run instead of starting a new one",
+        )
+        parser.add_argument(
+            "--shard",
+            "-s",
+            type=parse_shard,
+            default=(0, 1),
+            metavar="i/N",
+            help=(
+                "Only update the i-th of N shards of the players, to split the"
+                " update between N workers, each with its share of the API keys"
+            ),
+        )
+        parser.add_argument(
+            "--wait",
+            "-w",
+            action="store_true",
+            help="Wait for the running update to finish instead of exiting",
+        )
         return super().add_arguments(parser)
 
     def handle(self, *args, **options):
-        forced_update = options["force"]
+        logger.info("Starting update_all_players command...")
+        self.shard_index, self.shard_count = options["shard"]
+        if self.shard_count > 1:
+            logger.info(f"Updating shard {self.shard_index}/{self.shard_count}")
+
+        # A run can last longer than the cron interval, the next one must not
+        # update the same players at the same time, whether it runs the same
+        # shard or splits the players into another number of shards
+        self.run_lock = ShardedRunLock(
+            "update_all_players", self.shard_index, self.shard_count
+        )
+        if options["wait"]:
+            self.run_lock.wait()
+        elif not self.run_lock.acquire():
+            logger.info("Another update_all_players is running this shard, exiting")
+            self.stdout.write(
+                self.style.WARNING("Another update is already running"), ending="\n"
+            )
+            return
+        try:
+            self.update_all_players(options["force"], options["resume"])
+        finally:
+            self.run_lock.release()
+
+    def update_all_players(self, forced_update: bool, resume: bool) -> None:
+        """Update the players of this shard, see handle for the options."""
         if forced_update:
             logger.info("Forced update")
-        logger.info("Starting update_all_players command...")
+        brawl_api.use_shard(self.shard_index, self.shard_count)
         if not forced_update:
             min_time_since_last_update = datetime.now(timezone.utc) - timedelta(hours=8)
         else:
@@ -55,37 +123,141 @@ class Command(BaseCommand):
 
         # Because these are small tables, to save on number of queries, we'll
         # fetch all the data we need in memory
-        self.all_brawlers = Brawler.objects.all()
-        self.all_maps = BrawlMap.objects.all()
+        self.all_brawlers = NameIndex(Brawler)
+        self.all_maps = NameIndex(BrawlMap)
 
         # last_club_league_day and today_number_of_remaining_tickets are used
         # to calculate the number of remaining tickets for each player
-        self.last_club_league_day = get_last_club_league_day_start()
-        self.today_number_of_remaining_tickets = get_today_number_of_remaining_tickets()
+        # Called through utils so the club league status is the same everywhere,
+        # including when it is mocked in tests
+        self.last_club_league_day = utils.get_last_club_league_day_start()
+        self.today_number_of_remaining_tickets = (
+            utils.get_today_number_of_remaining_tickets()
+        )
 
         # Because computing the Brawlclub rating is a bit expensive, we do it
         # only while the club league is running
-        self.club_league_running = get_club_league_status()
-        last_update = PlayersUpdate.objects.last()
+        self.club_league_running = utils.get_club_league_status()
+        self.players_update = None
+        if resume:
+            self.players_update = self.get_run_to_resume()
+
+        if self.players_update:
+            # The remaining tickets were already updated when the run started,
+            # and we keep updating the same players as the interrupted run
+            min_time_since_last_update = self.players_update.min_last_updated
+        else:
+            self.players_update = self.start_new_run(min_time_since_last_update)
+
+        # Prepare a list of players that need to be updated
+        queryset = Player.objects.filter(
+            Q(last_updated__lte=min_time_since_last_update) | Q(last_updated=None)
+        )
+
+        self.update_all_batches(
+            self.batch_qs(queryset, 500, self.players_update.last_position)
+        )
+
+        self.players_update.completed = True
+        self.players_update.save(update_fields=["completed", "last_update"])
+
+        if unknown_match_types:
+            # MATCH_TYPES needs an update
+            logger.warning(
+                "Unknown match types (outcome, trophies won):"
+                f" {dict(unknown_match_types)}. Their battles were saved as"
+                f" {UNKNOWN_MATCH}, run reclassify_matches once MATCH_TYPES"
+                " knows them."
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS("Successfully updated all players"), ending="\n"
+        )
+
+    def get_run_to_resume(self) -> Union[PlayersUpdate, None]:
+        """Return the interrupted run of this shard, None if there is none.
+
+        Only the latest run of the shard is resumed, if it didn't complete, and
+        as long as the club league day it computed the remaining tickets for is
+        still the current one. Otherwise a new run resets the tickets.
+        """
+        latest_run = (
+            PlayersUpdate.objects.filter(
+                shard_index=self.shard_index, shard_count=self.shard_count
+            )
+            .order_by("pk")
+            .last()
+        )
+        if (
+            latest_run is None
+            or latest_run.completed
+            or latest_run.min_last_updated is None
+        ):
+            logger.info("No interrupted run to resume, starting a new one")
+            return None
+        if (
+            latest_run.club_league_running != self.club_league_running
+            or latest_run.last_club_league_day != self.last_club_league_day
+        ):
+            logger.info(
+                f"The club league day changed since run {latest_run.pk} started,"
+                " starting a new one"
+            )
+            return None
+        logger.info(
+            f"Resuming run {latest_run.pk}, "
+            f"{latest_run.players_updated} players already updated"
+        )
+        return latest_run
+
+    def start_new_run(self, min_time_since_last_update: datetime) -> PlayersUpdate:
+        """Record a new run, updating the remaining tickets of all players first.
+
+        Keyword arguments:
+        min_time_since_last_update -- players last updated before are updated
+
+        Returns:
+        The PlayersUpdate where the run's progress is saved
+        """
+        # The remaining tickets of all players are updated once per run of the
+        # job, by its first shard. The ShardedRunLock makes sure a single first
+        # shard runs at a time.
+        if self.shard_index == 0:
+            self.update_all_remaining_tickets()
+
+        # We can create a PlayersUpdate object now, because we updated the
+        # remaining tickets for all players, we want to avoid repeating that work
+        # if the update_all_players command is interrupted
+        return PlayersUpdate.objects.create(
+            club_league_running=self.club_league_running,
+            last_club_league_day=self.last_club_league_day,
+            min_last_updated=min_time_since_last_update,
+            shard_index=self.shard_index,
+            shard_count=self.shard_count,
+        )
+
+    def update_all_remaining_tickets(self) -> None:
+        """Reset the remaining tickets of the players not updated this club
+        league day."""
+        # Previous run of this shard, its club league status is the one the
+        # tickets were last updated for
+        last_update = (
+            PlayersUpdate.objects.filter(
+                shard_index=self.shard_index, shard_count=self.shard_count
+            )
+            .order_by("pk")
+            .last()
+        )
 
         if not self.club_league_running:
-            # Update the remaining tickets for all players if necessary
-            if last_update.club_league_running:
+            # Update the remaining tickets for all players if necessary, we
+            # don't know whether club league was running without a previous run
+            if last_update is None or last_update.club_league_running:
                 logger.info(
                     "Club league is not running anymore,"
                     " updating remaining tickets to 0"
                 )
                 Player.objects.update(number_of_available_tickets=0)
-
-            # Prepare a list of players that need to be updated
-            queryset = (
-                Player.objects.filter(
-                    Q(last_updated__lte=min_time_since_last_update)
-                    | Q(last_updated=None)
-                )
-                .order_by("-brawlclub_rating", "last_updated")
-                .values_list("player_tag", flat=True)
-            )
         else:
             logger.info(
                 "Club league is running, updating remaining tickets"
@@ -96,69 +268,165 @@ class Command(BaseCommand):
                 | (Q(last_updated__isnull=True))
             ).update(number_of_available_tickets=self.today_number_of_remaining_tickets)
 
-            # Prepare a list of players that need to be updated
-            queryset = (
-                Player.objects.filter(
-                    Q(last_updated__lte=min_time_since_last_update)
-                    | Q(last_updated=None)
-                )
-                .order_by("-brawlclub_rating", "last_updated")
-                .values_list("player_tag", flat=True)
-            )
+    def batch_qs(
+        self,
+        qs: "QuerySet[Player]",
+        batch_size: int,
+        position: Union[list, None] = None,
+    ) -> Iterator[Tuple[int, int, int, list, tuple]]:
+        """Returns a (start, end, total, player tags, position) tuple for each
+        batch of players in the given queryset.
 
-        # We can create a PlayersUpdate object now, because we updated the
-        # remaining tickets for all players, we want to avoid repeating that work
-        # if the update_all_players command is interrupted
-        PlayersUpdate.objects.create(club_league_running=self.club_league_running)
+        Batches are fetched with keyset pagination on UPDATE_ORDERING: players
+        leave the queryset as soon as they are updated, which would make an
+        OFFSET skip the following players.
+
+        When the update is sharded, every worker reads the same pages, N times
+        bigger, and keeps the players of its shard. Start and end count the
+        rows read, shared by all the shards.
+
+        Keyword arguments:
+        qs -- Players to update
+        batch_size -- Number of players per batch
+        position -- Keyset position to start after, when resuming a run
+        """
+        total = qs.count()
+        start = 0
+        for batch, position in keyset_batches(
+            qs, UPDATE_ORDERING, batch_size * self.shard_count, position
+        ):
+            end = start + len(batch)
+            # player_tag is the last field of UPDATE_ORDERING
+            player_tags = [
+                row[-1]
+                for row in batch
+                if get_shard_index(row[-1], self.shard_count) == self.shard_index
+            ]
+            if player_tags:
+                yield (start, end, total, player_tags, position)
+            start = end
+
+    @async_to_sync
+    async def update_all_batches(self, batches: Iterator) -> None:
+        """Update every batch through a fetch -> save pipeline.
+
+        While a batch is being saved to the database, the next one is already
+        being fetched from the API. Both stages are linked by a bounded queue so
+        we never hold more than FETCHED_BATCHES_QUEUE_SIZE batches in memory.
 
-        for start, end, total, qs in self.batch_qs(queryset, 500):
+        Every batch is fetched within the same API session, so they share the
+        API client's connection pool, which is closed once every batch is done.
+
+        Keyword arguments:
+        batches -- iterator of (start, end, total, player tags, position) tuples
+        from batch_qs
+        """
+        fetched_batches = asyncio.Queue(maxsize=FETCHED_BATCHES_QUEUE_SIZE)
+        async with brawl_api.session():
+            fetch_stage = asyncio.create_task(
+                self.fetch_batches(batches, fetched_batches)
+            )
+            save_stage = asyncio.create_task(self.save_batches(fetched_batches))
+            # Keeps the run lock while the batches are updated
+            heartbeat = asyncio.create_task(self.run_lock.keep_alive())
+            stages = {fetch_stage, save_stage, heartbeat}
+            try:
+                # Stops as soon as a stage fails, so the other ones don't wait
+                # forever on the queue, or the run goes on without the lock
+                while not save_stage.done():
+                    done, stages = await asyncio.wait(
+                        stages, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for stage in done:
+                        stage.result()
+            finally:
+                for stage in (fetch_stage, save_stage, heartbeat):
+                    stage.cancel()
+
+    async def fetch_batches(self, batches: Iterator, fetched_batches: asyncio.Queue):
+        """Fetch stage : fetch each batch from the API and queue it to be saved."""
+        while True:
+            # Getting the next batch queries the database
+            batch = await sync_to_async(next)(batches, None)
+            if batch is None:
+                break
+            start, end, total, player_tags, position = batch
             logger.info(
-                f"Updating row {start} to {end} on {total} ({start/total*100:.2f}%)"
+                f"Fetching row {start} to {end} on {total} ({start/total*100:.2f}%)"
             )
-            self.update_player_batch(qs)
-
-        self.stdout.write(
-            self.style.SUCCESS("Successfully updated all players"), ending="\n"
-        )
+            time_start = time.time()
+            fetched_batch = await self.get_all_players_profiles_and_battlelog(
+                player_tags
+            )
+            logger.info(f"Fetched in {time.time() - time_start:.2f}s")
+            # Waits if the save stage is behind
+            await fetched_batches.put((fetched_batch, position))
+        # Tells the save stage there is nothing left to save
+        await fetched_batches.put(None)
+
+    async def save_batches(self, fetched_batches: asyncio.Queue):
+        """Save stage : save each fetched batch to the database."""
+        while True:
+            item = await fetched_batches.get()
+            if item is None:
+                break
+            fetched_batch, position = item
+            time_start = time.time()
+            players_count = await sync_to_async(self.save_player_batch)(*fetched_batch)
+            await sync_to_async(self.save_checkpoint)(position, players_count)
+            logger.info(f"Done! Time elapsed : {time.time() - time_start:.2f}s")
+
+    def save_checkpoint(self, position: tuple, players_count: int) -> None:
+        """Save the progress of the run once a batch is saved.
 
-    def batch_qs(self, qs: "QuerySet", batch_size):
-        """Returns a (start, end, total, queryset) tuple for each batch in the given
-        queryset.
-
-        Usage:
-            # Make sure to order your querset
-            article_qs = Article.objects.order_by('id')
-            for start, end, total, qs in batch_qs(article_qs):
-                print("Now processing %s - %s of %s" % (start + 1, end, total))
-                for article in qs:
-                    print(article.body)
+        Keyword arguments:
+        position -- Keyset position of the last player of the batch
+        players_count -- Number of players updated in the batch
         """
-        total = qs.count()
-        for start in range(0, total, batch_size):
-            end = start + batch_size
-            yield (start, end, total, qs[start:end])
+        self.players_update.last_position = position
+        self.players_update.batches_done += 1
+        self.players_update.players_updated += players_count
+        self.players_update.save(
+            update_fields=[
+                "last_position",
+                "batches_done",
+                "players_updated",
+                "last_update",
+            ]
+        )
 
-    def update_player_batch(self, player_batch):
+    def save_player_batch(
+        self, tag_battlelog: dict, tag_clubtag: dict, tag_info: dict
+    ) -> int:
+        """Save the matches and infos of a batch of players fetched from the API.
 
-        time_start = time.time()
-        logger.info("Fetching player batch's profiles and battlelogs from API...")
-        (
-            tag_battlelog,
-            tag_clubtag,
-            tag_info,
-        ) = self.get_all_players_profiles_and_battlelog(player_batch)
+        Keyword arguments:
+        tag_battlelog -- Dict matching player tag and battle log
+        tag_clubtag -- Dict matching player tag and club tag
+        tag_info -- Dict matching player tag and player info
 
+        Returns:
+        The number of updated players
+        """
         logger.info("Creating matches from battlelog ...")
-        match_batch = []
+        # New brawlers and maps of the batch are created at once
+        brawler_names, map_names = get_battlelogs_names(tag_battlelog.values())
+        self.all_brawlers.add_missing(brawler_names)
+        self.all_maps.add_missing(map_names)
+        # Each match is built once even if several players of the batch
+        # played it, and the whole batch is saved at once
+        match_registry = MatchRegistry()
         for tag, battlelog in tag_battlelog.items():
-            matches = create_matches_from_battlelog(
-                tag, battlelog, self.all_brawlers, self.all_maps
+            create_matches_from_battlelog(
+                tag, battlelog, self.all_brawlers, self.all_maps, match_registry
             )
-            match_batch.extend(matches)
 
-        if match_batch:
-            logger.info(f"Saving {len(match_batch)} matches...")
-            MatchIssue.objects.bulk_create(match_batch)
+        logger.info(
+            f"Saving {len(match_registry.new_matches)} matches and"
+            f" {len(match_registry.new_match_issues)} match issues,"
+            " skipping those already saved..."
+        )
+        match_registry.save()
 
         logger.info("Updating players clubs and infos...")
         player_batch = self.update_player_infos(tag_clubtag, tag_info)
@@ -168,9 +436,9 @@ class Command(BaseCommand):
         for player in player_batch:
             player: Player
             player.last_updated = datetime.now(timezone.utc)
-            if self.club_league_running:
-                player.update_brawlclub_rating(save=False)
             player_batch_to_update.append(player)
+        if self.club_league_running:
+            update_batch_brawlclub_ratings(player_batch_to_update)
 
         if self.club_league_running:
             logger.info("Updating players' remaining tickets...")
@@ -199,17 +467,15 @@ class Command(BaseCommand):
                 "number_of_available_tickets",
             ],
         )
-        time_end = time.time()
-        logger.info(f"Done! Time elapsed : {time_end - time_start}")
+        return len(player_batch_to_update)
 
-    @async_to_sync
     async def get_all_players_profiles_and_battlelog(
         self, players
     ) -> Tuple[dict, dict, dict]:
         """Get all players profiles and battlelogs.
 
         Keyword arguments:
-        players -- Queryset of Player model
+        players -- List of player tags
 
         Returns
         Tuple with :
@@ -217,48 +483,53 @@ class Command(BaseCommand):
         Dict matching player tag and club tag
         Dict matching player tag and player info
         """
-        players = await sync_to_async(list)(players)
-        api_calls = []
-        async with httpx.AsyncClient(timeout=3600) as client:
-            for tag in players:
-                response = get_player_data(tag, client)
-                api_calls.append(response)
-            responses = await asyncio.gather(*api_calls)
-        results = {"Player data": responses}
-        tag_profile = {}
-        for player in results["Player data"]:
-            try:
-                tag_profile[player["tag"]] = player
-            except KeyError:
-                logger.info("request throttled, skipping")
-                continue
+        # Profiles and battlelogs share the same retry budget
+        retry_budget = RetryBudget.for_batch(len(players) * 2)
         api_calls = []
+        for tag in players:
+            # Profile and battlelog are requested together
+            response = get_player_profile_and_battlelog(tag, retry_budget)
+            api_calls.append(response)
+        responses = await asyncio.gather(*api_calls)
+        tag_battlelog = {}
         tag_clubtag = {}
         tag_info = {}
-        async with httpx.AsyncClient(timeout=3600) as client:
-            for tag, profile in tag_profile.items():
-                if profile["club"]:
-                    club_tag = profile["club"]["tag"]
-                    tag_clubtag[tag] = club_tag
-                else:
-                    tag_clubtag[tag] = None
-                # Update the general infos : Level, trophies, etc.
-                tag_info[tag] = {
-                    "player_name": profile.get("name", "Undefined"),
-                    "level": profile.get("expLevel", 0),
-                    "trophy_count": profile.get("trophies", 0),
-                    "total_3v3_wins": profile.get("3vs3Victories", 0),
-                    "solo_wins": profile.get("soloVictories", 0),
-                    "duo_wins": profile.get("duoVictories", 0),
-                }
-                response = get_player_battlelog(tag, client)
-                api_calls.append(response)
-            battlelogs = await asyncio.gather(*api_calls)
-        tag_battlelog = {}
-        for tag, battlelog in zip(tag_profile.keys(), battlelogs):
+        for profile, battlelog in responses:
+            if "tag" not in profile:
+                # Still throttled after all retries, the player isn't marked as
+                # updated so the next run fetches it again
+                logger.info(
+                    f"Profile unavailable ({profile.get('reason')}),"
+                    " player will be fetched in the next run"
+                )
+                continue
+            tag = profile["tag"]
+            if "items" not in battlelog and battlelog.get("reason") != "notFound":
+                # Same as profiles, the player will be fetched in the next run
+                logger.info(
+                    f"{tag}: Battlelog unavailable ({battlelog.get('reason')}),"
+                    " player will be fetched in the next run"
+                )
+                continue
             tag_battlelog[tag] = battlelog
+            if profile["club"]:
+                club_tag = profile["club"]["tag"]
+                tag_clubtag[tag] = club_tag
+            else:
+                tag_clubtag[tag] = None
+            # Update the general infos : Level, trophies, etc.
+            tag_info[tag] = {
+                "player_name": profile.get("name", "Undefined"),
+                "level": profile.get("expLevel", 0),
+                "trophy_count": profile.get("trophies", 0),
+                "total_3v3_wins": profile.get("3vs3Victories", 0),
+                "solo_wins": profile.get("soloVictories", 0),
+                "duo_wins": profile.get("duoVictories", 0),
+            }
 
-        logger.info(f"Number of to be updated players : {len(tag_profile.keys())}")
+        logger.info(f"Retries used for this batch : {retry_budget.retries_used}")
+
+        logger.info(f"Number of to be updated players : {len(tag_info.keys())}")
         return tag_battlelog, tag_clubtag, tag_info
 
     def update_player_infos(self, tag_clubtag: dict, tag_infos: dict) -> list:
@@ -271,13 +542,27 @@ class Command(BaseCommand):
         Returns:
         The updated player batch
         """
+        # The players of the batch and the clubs they joined are loaded with a
+        # query each, instead of a few queries per player
+        players = Player.objects.select_related("club").in_bulk(list(tag_clubtag))
+        new_club_tags = {
+            clubtag
+            for tag, clubtag in tag_clubtag.items()
+            if clubtag
+            and tag in players
+            and (players[tag].club is None or players[tag].club.club_tag != clubtag)
+        }
+        clubs = Club.objects.in_bulk(new_club_tags) if new_club_tags else {}
+
         players_to_update = []
         clubs_to_create = []
         players_with_club_to_create = []
         for tag, clubtag in tag_clubtag.items():
-            player: Player = Player.objects.select_related("club").get(player_tag=tag)
+            player: Player = players.get(tag)
+            if player is None:
+                # Deleted since the batch was selected
+                continue
             this_players_infos = tag_infos[tag]
-            already_to_be_updated = False
             if this_players_infos:
                 player.player_name = this_players_infos["player_name"]
                 player.level = this_players_infos["level"]
@@ -288,29 +573,26 @@ class Command(BaseCommand):
 
             if clubtag is None:
                 player.club = None
-                players_to_update.append(player)
+            elif clubtag in clubs:
+                player.club = clubs[clubtag]
+            elif clubtag in new_club_tags:
+                clubs_to_create.append(clubtag)
+                players_with_club_to_create.append(player)
                 continue
-            if player.club and player.club.club_tag == clubtag:
-                players_to_update.append(player)
-                continue
-            else:
-                club = Club.objects.filter(club_tag=clubtag).first()
-                if club:
-                    player.club = club
-                else:
-                    clubs_to_create.append(clubtag)
-                    players_with_club_to_create.append(player)
-                    already_to_be_updated = True
-
-            if not already_to_be_updated:
-                players_to_update.append(player)
+            players_to_update.append(player)
 
         if clubs_to_create:
             club_batch = self.create_club_batch(clubs_to_create)
-            Club.objects.bulk_create(club_batch)
-        if players_with_club_to_create:
+            # The club tag is the primary key, the created clubs can be used
+            # as they are
+            created_clubs = {
+                club.club_tag: club for club in Club.objects.bulk_create(club_batch)
+            }
             for player in players_with_club_to_create:
-                player.club = Club.objects.get(club_tag=tag_clubtag[player.player_tag])
+                # The club is missing if the API couldn't give its information
+                player.club = created_clubs.get(
+                    tag_clubtag[player.player_tag], player.club
+                )
                 players_to_update.append(player)
 
         return players_to_update
@@ -326,15 +608,20 @@ class Command(BaseCommand):
         club_batch = []
 
         logger.info("Fetching club to create data from API...")
-        async with httpx.AsyncClient(timeout=None) as client:
+        retry_budget = RetryBudget.for_batch(len(clubs_to_create))
+        async with brawl_api.session():
             tasks = []
             for club_tag in clubs_to_create:
-                task = self.get_club_information(club_tag, client)
+                task = self.get_club_information(club_tag, retry_budget)
                 tasks.append(task)
             responses = await asyncio.gather(*tasks)
         logger.info(f"Creating {len(tasks)} clubs...")
 
         for club_information in responses:
+            if "tag" not in club_information:
+                # Players of this club keep their current club until next run
+                logger.info(f"Club unavailable ({club_information.get('reason')})")
+                continue
             kwargs = {
                 "club_tag": club_information["tag"],
                 "club_name": club_information["name"],
@@ -349,15 +636,15 @@ class Command(BaseCommand):
         return club_batch
 
     async def get_club_information(
-        self, clubtag: str, client: httpx.AsyncClient
+        self, clubtag: str, retry_budget: Union[RetryBudget, None] = None
     ) -> dict:
         """Get club information.
 
         Keyword arguments:
         clubtag -- Club tag
+        retry_budget -- Retry budget shared with the other calls of the batch
         """
         clubtag = clubtag[1:]
         url = f"{brawl_api.base_url}clubs/%23{clubtag}"
-        response = await client.get(url, headers=brawl_api.headers)
-        response = response.json()
-        return response
+        # An error payload when the club can't be fetched, see create_club_batch
+        return await brawl_api.get_json(url, retry_budget)
@@ -0,0 +1,100 @@
+from collections import Counter
+from typing import Dict, Sequence, Tuple, Union
+
+import numpy as np
+
+POWER_MATCH = "Power Match"
+NORMAL_MATCH = "Normal Match"
+# Battle type of the matches whose type isn't in MATCH_TYPES yet
+UNKNOWN_MATCH = "Unknown Match"
+
+# Club league trophies won tell the type of a match:
+# (outcome, trophies won) -> (is power match, played with a clubmate)
+# Can't draw in Power matches.
+MATCH_TYPES: Dict[Tuple[str, int], Tuple[bool, bool]] = {
+    ("WIN", 9): (True, True),
+    ("WIN", 7): (True, False),
+    ("WIN", 4): (False, True),
+    ("WIN", 3): (False, False),
+    ("LOSS", 5): (True, True),
+    ("LOSS", 3): (True, False),
+    ("LOSS", 2): (False, True),
+    ("LOSS", 1): (False, False),
+    ("DRAW", 3): (False, True),
+    ("DRAW", 2): (False, False),
+}
+
+# Combinations missing from MATCH_TYPES seen by this process, e.g. after a game
+# update changed the trophies won. They are counted rather than guessed, and
+# their matches are saved as UNKNOWN_MATCH.
+unknown_match_types: Counter = Counter()
+
+
+def get_match_type(
+    outcome: str, trophies_won: Union[int, None]
+) -> Union[Tuple[bool, bool], None]:
+    """Return the match type of a match issue.
+
+    Keyword arguments:
+    outcome -- WIN, LOSS or DRAW
+    trophies_won -- club league trophies won by the player
+
+    Returns:
+    A tuple with two booleans: is it a power match, and did the player play
+    with a clubmate. None if the combination is unknown.
+    """
+    match_type = MATCH_TYPES.get((outcome, trophies_won))
+    if match_type is None:
+        unknown_match_types[(outcome, trophies_won)] += 1
+    return match_type
+
+
+# Same table as arrays indexed by [outcome, trophies won], to classify many
+# match issues at once
+OUTCOMES = ("WIN", "LOSS", "DRAW")
+_MAX_TROPHIES_WON = max(trophies_won for _, trophies_won in MATCH_TYPES)
+_TABLE_SHAPE = (len(OUTCOMES), _MAX_TROPHIES_WON + 1)
+_KNOWN = np.zeros(_TABLE_SHAPE, dtype=bool)
+_IS_POWER_MATCH = np.zeros(_TABLE_SHAPE, dtype=bool)
+_PLAYED_WITH_CLUBMATE = np.zeros(_TABLE_SHAPE, dtype=bool)
+for (_outcome, _trophies_won), (_power, _clubmate) in MATCH_TYPES.items():
+    _index = (OUTCOMES.index(_outcome), _trophies_won)
+    _KNOWN[_index] = True
+    _IS_POWER_MATCH[_index] = _power
+    _PLAYED_WITH_CLUBMATE[_index] = _clubmate
+
+
+def get_match_types(
+    outcomes: Sequence[str], trophies_won: Sequence[int]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Vectorized get_match_type, to reclassify match issues in bulk.
+
+    Keyword arguments:
+    outcomes -- outcome of each match issue
+    trophies_won -- trophies won of each match issue
+
+    Returns:
+    Three boolean arrays: is the combination known, is it a power match, did
+    the player play with a clubmate. Unknown combinations are False in the
+    last two and aren't counted in unknown_match_types.
+    """
+    outcomes = np.asarray(outcomes)
+    trophies_won = np.asarray(trophies_won, dtype=np.int64)
+    outcome_indexes = np.full(outcomes.shape, -1)
+    for outcome_index, outcome in enumerate(OUTCOMES):
+        outcome_indexes[outcomes == outcome] = outcome_index
+
+    in_table = (
+        (outcome_indexes >= 0)
+        & (trophies_won >= 0)
+        & (trophies_won <= _MAX_TROPHIES_WON)
+    )
+    # Out of table values point to a cell of the table, masked by in_table
+    rows = np.where(in_table, outcome_indexes, 0)
+    columns = np.where(in_table, trophies_won, 0)
+    known = in_table & _KNOWN[rows, columns]
+    return (
+        known,
+        known & _IS_POWER_MATCH[rows, columns],
+        known & _PLAYED_WITH_CLUBMATE[rows, columns],
+    )
@@ -0,0 +1,45 @@
+# Generated by Django 4.0.8 on 2026-10-18 06:29
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('player_lookup', '0009_auto_20221130_1254'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playersupdate',
+            name='batches_done',
+            field=models.IntegerField(default=0),
+        ),
+        # Runs made before checkpoints existed can't be resumed
+        migrations.AddField(
+            model_name='playersupdate',
+            name='completed',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterField(
+            model_name='playersupdate',
+            name='completed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='playersupdate',
+            name='last_position',
+            field=models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True),
+        ),
+        migrations.AddField(
+            model_name='playersupdate',
+            name='min_last_updated',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='playersupdate',
+            name='players_updated',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.8 on 2026-10-18 07:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('player_lookup', '0010_playersupdate_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playersupdate',
+            name='shard_count',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='playersupdate',
+            name='shard_index',
+            field=models.IntegerField(default=0),
+        ),
+    ]
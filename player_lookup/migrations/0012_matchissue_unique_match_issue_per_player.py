@@ -0,0 +1,35 @@
+# Generated by Django 4.0.8 on 2026-10-18 08:03
+
+from django.db import migrations, models
+
+
+def delete_duplicate_match_issues(apps, schema_editor):
+    MatchIssue = apps.get_model("player_lookup", "MatchIssue")
+    # Concurrent ingestions of the same battles could save a match issue twice,
+    # we keep the first one saved
+    duplicates = (
+        MatchIssue.objects.values("match_id", "player_id")
+        .annotate(first_id=models.Min("id"), count=models.Count("id"))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        MatchIssue.objects.filter(
+            match_id=duplicate["match_id"], player_id=duplicate["player_id"]
+        ).exclude(id=duplicate["first_id"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('player_lookup', '0011_playersupdate_shard'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            delete_duplicate_match_issues, reverse_code=migrations.RunPython.noop
+        ),
+        migrations.AddConstraint(
+            model_name='matchissue',
+            constraint=models.UniqueConstraint(fields=('match', 'player'), name='unique_match_issue_per_player'),
+        ),
+    ]
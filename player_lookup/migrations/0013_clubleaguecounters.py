@@ -0,0 +1,26 @@
+# Generated by Django 4.0.8 on 2026-10-18 06:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('player_lookup', '0012_matchissue_unique_match_issue_per_player'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClubLeagueCounters',
+            fields=[
+                ('player', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='club_league_counters', serialize=False, to='player_lookup.player')),
+                ('since', models.DateTimeField()),
+                ('all_matches_count', models.IntegerField(default=0)),
+                ('all_wins', models.IntegerField(default=0)),
+                ('all_losses', models.IntegerField(default=0)),
+                ('played_with_clubmate', models.IntegerField(default=0)),
+                ('power_match', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.8 on 2026-10-18 07:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('player_lookup', '0013_clubleaguecounters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playersupdate',
+            name='last_club_league_day',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,10 +1,10 @@
 from collections import defaultdict
 from datetime import datetime, timezone
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Dict, Iterable, List, Union
 import logging
 
-from django.db import models
-from freezegun import freeze_time
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
 
 from player_lookup.utils import (
     get_number_of_weeks_since_date,
@@ -74,30 +74,11 @@ class Player(models.Model):
         # Players under 900 trophies don't have clubs
         if self.trophy_count < 900:
             return
-        match_issues = list(MatchIssue.objects.filter(player=self).select_related(
-            "match"
-        ))
-
-        # Because filters do hit the database while we only need counts here,
-        # also because this list is not huge, we store in memory the matches
-        self.match_data = defaultdict(int)
-
-        for match in match_issues:
-            match: MatchIssue
-            if match.match.date > self.default_date:
-
-                self.match_data["all_matches_count"] += 1
-
-                if match.outcome == "WIN":
-                    self.match_data["all_wins"] += 1
-                elif match.outcome == "LOSS":
-                    self.match_data["all_losses"] += 1
-
-                if match.played_with_clubmate:
-                    self.match_data["played_with_clubmate"] += 1
-
-                if match.match.battle_type == "Power Match":
-                    self.match_data["power_match"] += 1
+        # The matches since default_date are counted as they are saved, see
+        # ClubLeagueCounters
+        self.match_data = defaultdict(
+            int, get_club_league_counters([self]).get(self.player_tag, {})
+        )
 
         if self.match_data["all_matches_count"] > 0:
             rate = (
@@ -169,8 +150,9 @@ class Player(models.Model):
 
         Every other week, one has 14 tickets to spend, from wednesday to wednesday.
         """
-        with freeze_time(self.default_date.strftime("%Y-%m-%d")):
-            first_weeks_number_of_tickets = get_this_weeks_number_of_remaining_tickets()
+        first_weeks_number_of_tickets = get_this_weeks_number_of_remaining_tickets(
+            self.default_date
+        )
 
         this_weeks_number_of_available_tickets = (
             get_this_weeks_number_of_available_tickets()
@@ -224,28 +206,23 @@ def update_player_batch_remaining_tickets(
     Returns:
         list: A list of players with their remaining tickets updated.
     """
-    # We're fetching all matches from the last club league day for current batch
-    # This means possibly fetching up to 6 matches per player
-    player_batch_match_issues = MatchIssue.objects.select_related("match").filter(
-        player__in=player_batch, match__date__gte=last_club_league_day_start
+    # A single grouped query counts the matches each player of the batch
+    # played since the last club league day started
+    tickets_spent_per_player = dict(
+        MatchIssue.objects.filter(
+            player__in=player_batch, match__date__gte=last_club_league_day_start
+        )
+        .values("player")
+        .annotate(
+            # Each power match uses 2 tickets, each normal match uses 1 ticket
+            tickets_spent=models.Count("id")
+            + models.Count("id", filter=models.Q(match__battle_type="Power Match"))
+        )
+        .values_list("player", "tickets_spent")
     )
     updated_players = []
     for player in player_batch:
-        tickets_spent = 0
-        this_players_match_issues = player_batch_match_issues.filter(player=player)
-        all_power_matches_count = this_players_match_issues.filter(
-            player=player,
-            match__date__gte=last_club_league_day_start,
-            match__battle_type="Power Match",
-        ).count()
-        # Each power match uses 2 tickets
-        tickets_spent += all_power_matches_count * 2
-        # Each normal match uses 1 ticket
-        all_normal_matches_count = (
-            this_players_match_issues.count() - all_power_matches_count
-        )
-        tickets_spent += all_normal_matches_count
-
+        tickets_spent = tickets_spent_per_player.get(player.player_tag, 0)
         player.number_of_available_tickets = today_number_of_tickets - tickets_spent
 
         updated_players.append(player)
@@ -375,15 +352,256 @@ class MatchIssue(models.Model):
     is_star_player = models.BooleanField(default=False)
     played_with_clubmate = models.BooleanField(default=False)
 
+    class Meta:
+        constraints = [
+            # A player has a single issue per match, ingestion relies on it to
+            # skip the match issues already saved
+            models.UniqueConstraint(
+                fields=["match", "player"], name="unique_match_issue_per_player"
+            ),
+        ]
+
     def __str__(self):  # pragma: no cover
         return f"{self.player} - {self.brawler} - {self.match}"
 
 
+# Counts of the club league matches of a player, see ClubLeagueCounters
+CLUB_LEAGUE_COUNTER_FIELDS = (
+    "all_matches_count",
+    "all_wins",
+    "all_losses",
+    "played_with_clubmate",
+    "power_match",
+)
+
+
+# Since of the counters created before their first count, they are counted when
+# first read as it isn't the default date of any player
+NOT_COUNTED_SINCE = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class ClubLeagueCounters(models.Model):
+    """Club league matches of a player since its default_date.
+
+    Rating a player reads this row instead of counting all its match issues.
+    The counters are incremented as MatchRegistry saves new match issues, and
+    built from the match issues when they are missing, not counted yet or the
+    player's default_date changed. Match issues saved another way aren't counted: the
+    rebuild_club_league_counters command reconciles the counters with the
+    match issues.
+    """
+
+    player = models.OneToOneField(
+        Player,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="club_league_counters",
+    )
+    # Default date of the player the matches are counted from
+    since = models.DateTimeField()
+    all_matches_count = models.IntegerField(default=0)
+    all_wins = models.IntegerField(default=0)
+    all_losses = models.IntegerField(default=0)
+    played_with_clubmate = models.IntegerField(default=0)
+    power_match = models.IntegerField(default=0)
+
+    def __str__(self):  # pragma: no cover
+        return f"Club league counters of {self.player_id}"
+
+    def get_counts(self) -> Dict[str, int]:
+        return {field: getattr(self, field) for field in CLUB_LEAGUE_COUNTER_FIELDS}
+
+
+def count_club_league_matches(players: Iterable[Player]) -> Dict[str, dict]:
+    """Count the club league matches of a batch of players with a single query.
+
+    Only matches played after the player's default_date are counted.
+
+    Returns:
+        dict: The counts of each player having matches, by player tag.
+    """
+    match_counts = (
+        MatchIssue.objects.filter(
+            player__in=players, match__date__gt=models.F("player__default_date")
+        )
+        .values("player")
+        .annotate(
+            all_matches_count=models.Count("id"),
+            all_wins=models.Count("id", filter=models.Q(outcome="WIN")),
+            all_losses=models.Count("id", filter=models.Q(outcome="LOSS")),
+            played_with_clubmate=models.Count(
+                "id", filter=models.Q(played_with_clubmate=True)
+            ),
+            power_match=models.Count(
+                "id", filter=models.Q(match__battle_type="Power Match")
+            ),
+        )
+    )
+    return {counts.pop("player"): counts for counts in match_counts}
+
+
+def lock_club_league_counters(
+    player_tags: Iterable[str],
+) -> Dict[str, ClubLeagueCounters]:
+    """Lock the counters of players until the end of the transaction.
+
+    Savers of match issues take the lock before looking for the issues already
+    saved, so two of them can't both count the same issue, and rebuilds take it
+    before counting the match issues, so they don't miss those of a save.
+
+    Missing counters are created first, as not counted yet, so there is a row
+    to lock. While another transaction creates the same row, we wait for it.
+
+    Args:
+        player_tags (iterable): Tags of the players.
+
+    Returns:
+        dict: The locked counters by player tag.
+    """
+    # Created and locked in the same order by everyone, to avoid deadlocks
+    player_tags = sorted(set(player_tags))
+    ClubLeagueCounters.objects.bulk_create(
+        [
+            ClubLeagueCounters(player_id=player_tag, since=NOT_COUNTED_SINCE)
+            for player_tag in player_tags
+        ],
+        ignore_conflicts=True,
+    )
+    return (
+        ClubLeagueCounters.objects.select_for_update()
+        .order_by("player")
+        .in_bulk(player_tags)
+    )
+
+
+def rebuild_club_league_counters(
+    players: List[Player],
+) -> Dict[str, ClubLeagueCounters]:
+    """Count the club league matches of a batch of players from their match
+    issues, and save the counters.
+
+    The counters are locked while the match issues are counted, so a
+    MatchRegistry saving match issues of these players at the same time either
+    commits before they are counted, or increments the rebuilt counters.
+
+    Returns:
+        dict: The counters of each player, by player tag.
+    """
+    with transaction.atomic():
+        counters = lock_club_league_counters(player.player_tag for player in players)
+        match_counts = count_club_league_matches(players)
+        for player in players:
+            counter = counters[player.player_tag]
+            counter.since = player.default_date
+            player_counts = match_counts.get(player.player_tag, {})
+            for field in CLUB_LEAGUE_COUNTER_FIELDS:
+                setattr(counter, field, player_counts.get(field, 0))
+        ClubLeagueCounters.objects.bulk_update(
+            counters.values(), ["since", *CLUB_LEAGUE_COUNTER_FIELDS]
+        )
+    return counters
+
+
+def get_club_league_counters(players: List[Player]) -> Dict[str, Dict[str, int]]:
+    """Return the counts of the club league matches of a batch of players.
+
+    A single query when the counters of the batch are up to date, the missing
+    or outdated ones are rebuilt.
+
+    Returns:
+        dict: The counts of each player, by player tag.
+    """
+    counters = ClubLeagueCounters.objects.in_bulk(
+        [player.player_tag for player in players]
+    )
+    outdated_players = [
+        player
+        for player in players
+        if player.player_tag not in counters
+        or counters[player.player_tag].since != player.default_date
+    ]
+    if outdated_players:
+        counters.update(rebuild_club_league_counters(outdated_players))
+    return {
+        player.player_tag: counters[player.player_tag].get_counts()
+        for player in players
+    }
+
+
+def add_to_club_league_counters(
+    match_issues: Iterable[MatchIssue],
+    counters: Union[Dict[str, ClubLeagueCounters], None] = None,
+) -> None:
+    """Count newly saved match issues in their players' counters.
+
+    The match issues must have their match attached. Players without counters,
+    or whose counters aren't counted yet, are skipped, theirs are built from
+    the match issues when first read.
+
+    Args:
+        match_issues (iterable): The new match issues.
+        counters (dict): The counters of their players, as locked by
+            lock_club_league_counters, read when not given.
+    """
+    match_issues = list(match_issues)
+    if counters is None:
+        counters = ClubLeagueCounters.objects.in_bulk(
+            {match_issue.player_id for match_issue in match_issues}
+        )
+    increments = {}
+    for match_issue in match_issues:
+        counter = counters.get(match_issue.player_id)
+        if (
+            counter is None
+            or counter.since == NOT_COUNTED_SINCE
+            or match_issue.match.date <= counter.since
+        ):
+            continue
+        increment = increments.setdefault(
+            match_issue.player_id, dict.fromkeys(CLUB_LEAGUE_COUNTER_FIELDS, 0)
+        )
+        increment["all_matches_count"] += 1
+        increment["all_wins"] += match_issue.outcome == "WIN"
+        increment["all_losses"] += match_issue.outcome == "LOSS"
+        increment["played_with_clubmate"] += match_issue.played_with_clubmate
+        increment["power_match"] += match_issue.match.battle_type == "Power Match"
+
+    for player_tag, increment in increments.items():
+        # Incremented in the database, with the since it was counted from in
+        # case the counters were rebuilt meanwhile
+        ClubLeagueCounters.objects.filter(
+            player_id=player_tag, since=counters[player_tag].since
+        ).update(
+            **{
+                field: models.F(field) + value
+                for field, value in increment.items()
+                if value
+            }
+        )
+
+
 class PlayersUpdate(models.Model):
-    """Keep track of the last time the players were updated."""
+    """Keep track of the last time the players were updated.
+
+    Each update_all_players run also saves its progress here once a batch is
+    done, so an interrupted run can be resumed.
+    """
 
     last_update = models.DateTimeField(auto_now=True)
     club_league_running = models.BooleanField(default=False)
+    # Start of the club league day when the run started, the remaining tickets
+    # were computed for this day
+    last_club_league_day = models.DateTimeField(null=True, blank=True)
+    # Players last updated before this date are updated by the run
+    min_last_updated = models.DateTimeField(null=True, blank=True)
+    # Keyset position of the last player of the last saved batch
+    last_position = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    batches_done = models.IntegerField(default=0)
+    players_updated = models.IntegerField(default=0)
+    completed = models.BooleanField(default=False)
+    # Runs split with --shard only update the players of their shard
+    shard_index = models.IntegerField(default=0)
+    shard_count = models.IntegerField(default=1)
 
     def __str__(self):  # pragma: no cover
         return f"Last update: {self.last_update}"
@@ -0,0 +1,114 @@
+import asyncio
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class TokenBucket:
+    """Throttle the requests made with a single API key.
+
+    The bucket holds up to `burst` tokens and is refilled with `rate` tokens
+    per second. Each request consumes one token.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        """Add the tokens earned since the last refill, up to the burst size."""
+        # The clock can't go backward, but a frozen clock in tests can
+        elapsed_time = max(0.0, now - self.last_refill)
+        earned_tokens = elapsed_time * self.rate
+        self.tokens = min(self.burst, self.tokens + earned_tokens)
+        self.last_refill = now
+
+    def time_until_next_token(self) -> float:
+        """Number of seconds to wait until a whole token is available."""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class ApiKeyPool:
+    """Distribute requests over several API keys, each with its own token bucket.
+
+    Each request takes a token from the least loaded key, which is the key with
+    the most tokens left. When every bucket is empty, we wait for the first
+    token to be refilled instead of firing the request and getting throttled.
+
+    The pool is shared between the event loops spawned by async_to_sync and
+    the synchronous views, so the buckets are protected by a thread lock.
+    """
+
+    def __init__(
+        self, api_keys: List[str], rates: List[float], bursts: List[int]
+    ) -> None:
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, TokenBucket] = {
+            api_key: TokenBucket(rate, burst)
+            for api_key, rate, burst in zip(api_keys, rates, bursts)
+        }
+
+    @property
+    def api_keys(self) -> List[str]:
+        return list(self._buckets.keys())
+
+    def shard(self, shard_index: int, shard_count: int) -> "ApiKeyPool":
+        """Return the pool a worker uses when the work is split in shard_count.
+
+        Each worker gets its own keys when there are enough of them. Otherwise
+        every worker uses all the keys, at a fraction of their rate, so the
+        workers together stay within each key's quota.
+        """
+        buckets = list(self._buckets.items())
+        if len(buckets) >= shard_count:
+            buckets = buckets[shard_index::shard_count]
+            share = 1
+        else:
+            share = shard_count
+        return ApiKeyPool(
+            [api_key for api_key, _ in buckets],
+            [bucket.rate / share for _, bucket in buckets],
+            [max(1, bucket.burst // share) for _, bucket in buckets],
+        )
+
+    def _try_acquire(self) -> Tuple[Optional[str], float]:
+        """Take a token from the least loaded key if one is available.
+
+        Returns:
+        A tuple with the API key (None if every bucket is empty) and the number
+        of seconds to wait before trying again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for bucket in self._buckets.values():
+                bucket.refill(now)
+
+            api_key, bucket = max(
+                self._buckets.items(), key=lambda item: item[1].tokens
+            )
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return api_key, 0.0
+
+            wait_time = min(
+                bucket.time_until_next_token() for bucket in self._buckets.values()
+            )
+            return None, wait_time
+
+    async def acquire(self) -> str:
+        """Wait for a token and return the API key it belongs to."""
+        while True:
+            api_key, wait_time = self._try_acquire()
+            if api_key:
+                return api_key
+            await asyncio.sleep(wait_time)
+
+    def acquire_sync(self) -> str:
+        """Blocking version of acquire, for the requests made outside an event loop"""
+        while True:
+            api_key, wait_time = self._try_acquire()
+            if api_key:
+                return api_key
+            time.sleep(wait_time)
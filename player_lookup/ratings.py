@@ -0,0 +1,97 @@
+from datetime import datetime
+from typing import List
+
+import numpy as np
+
+from player_lookup.models import (
+    CLUB_LEAGUE_COUNTER_FIELDS,
+    Player,
+    get_club_league_counters,
+)
+from player_lookup.utils import (
+    get_number_of_weeks_since_date,
+    get_this_weeks_number_of_available_tickets,
+    get_this_weeks_number_of_remaining_tickets,
+)
+
+# Players under this number of trophies don't have clubs, their rating isn't
+# updated
+MIN_TROPHIES_FOR_RATING = 900
+
+
+def get_available_tickets_since(default_date: datetime) -> int:
+    """Number of tickets a player could spend since their default_date.
+
+    Same as the denominator of Player.get_playrate.
+    """
+    first_weeks_number_of_tickets = get_this_weeks_number_of_remaining_tickets(
+        default_date
+    )
+    club_league_weeks_since = get_number_of_weeks_since_date(default_date)
+    return (
+        first_weeks_number_of_tickets
+        + club_league_weeks_since * 14
+        + get_this_weeks_number_of_available_tickets()
+    )
+
+
+def update_batch_brawlclub_ratings(players: List[Player]) -> None:
+    """Update the Brawlclub rating of a batch of players, without saving them.
+
+    Gives the same results as calling Player.update_brawlclub_rating on each
+    player, but the match counters of the whole batch are read with one query,
+    the calendar math is done once per default_date, and the rates of the
+    batch are computed at once with NumPy.
+    """
+    players = [
+        player for player in players if player.trophy_count >= MIN_TROPHIES_FOR_RATING
+    ]
+    if not players:
+        return
+
+    match_counts = get_club_league_counters(players)
+    available_tickets_since = {}
+    columns = {
+        field: np.zeros(len(players), dtype=np.int64)
+        for field in CLUB_LEAGUE_COUNTER_FIELDS
+    }
+    available_tickets = np.zeros(len(players), dtype=np.int64)
+    for index, player in enumerate(players):
+        for field, count in match_counts[player.player_tag].items():
+            columns[field][index] = count
+        if player.default_date not in available_tickets_since:
+            available_tickets_since[player.default_date] = get_available_tickets_since(
+                player.default_date
+            )
+        available_tickets[index] = available_tickets_since[player.default_date]
+
+    all_matches_count = columns["all_matches_count"]
+    played_matches = all_matches_count > 0
+    all_wins_and_losses = columns["all_wins"] + columns["all_losses"]
+    # Power matches use 2 tickets, normal matches 1 ticket
+    tickets_spent = all_matches_count + columns["power_match"]
+
+    def rate(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+        """numerator / denominator, 0 where the denominator is 0"""
+        return np.divide(
+            numerator,
+            denominator,
+            out=np.zeros(len(players)),
+            where=denominator != 0,
+        )
+
+    # Players without matches get a 0 everywhere
+    win_rate = np.where(
+        played_matches, rate(columns["all_wins"], all_wins_and_losses), 0
+    )
+    teamplay_rate = rate(columns["played_with_clubmate"], all_matches_count)
+    playrate = np.where(played_matches, rate(tickets_spent, available_tickets), 0)
+    brawlclub_rating = np.where(
+        played_matches, playrate * 50 + teamplay_rate * 30 + win_rate * 20, 0
+    )
+
+    for index, player in enumerate(players):
+        player.brawlclub_rating = float(brawlclub_rating[index])
+        player.club_league_winrate = float(win_rate[index])
+        player.club_league_playrate = float(playrate[index])
+        player.club_league_teamplay_rate = float(teamplay_rate[index])
@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, List
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+
+# A lock not refreshed for this long is considered abandoned, e.g. the process
+# holding it was killed
+LOCK_TTL = 15 * 60  # Seconds
+# The lock is refreshed several times per TTL, so a slow refresh doesn't lose it
+HEARTBEAT_INTERVAL = LOCK_TTL / 3
+WAIT_POLL_INTERVAL = 30  # Seconds
+
+logger = logging.getLogger("django")
+
+# Redis scripts checking the value of a lock and changing it in a single step,
+# so the lock can't expire and be taken by someone else in between
+EXPIRE_IF_EQUAL = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+DELETE_IF_EQUAL = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+# Only delete the first key when none of the others exist
+DELETE_IF_EQUAL_AND_UNUSED = """
+if redis.call('get', KEYS[1]) == ARGV[1]
+    and redis.call('exists', unpack(KEYS, 2)) == 0 then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Other caches (local memory in development) live in the process, holding this
+# lock while checking and changing a lock is enough to make it atomic
+_local_lock = threading.Lock()
+
+
+class RunLockLost(Exception):
+    """The lock expired and may now be held by another process."""
+
+
+def run_atomically(script: str, keys: List[str], args: list, fallback: Callable):
+    """Run a check-and-set on locks in a single step.
+
+    Args:
+        script (str): Redis script, run when the default cache is Redis.
+        keys (list): Cache keys the script reads and changes, as KEYS.
+        args (list): Arguments of the script, as ARGV. Strings and integers are
+            serialized like the cache serializes values.
+        fallback (callable): Does the same as the script with the cache API,
+            called under a process lock for the other caches.
+
+    Returns:
+        bool: What the script or the fallback returned.
+    """
+    redis_cache = getattr(cache, "_cache", None)
+    if not hasattr(redis_cache, "get_client"):
+        with _local_lock:
+            return bool(fallback())
+    client = redis_cache.get_client(write=True)
+    return bool(
+        client.eval(
+            script,
+            len(keys),
+            *[cache.make_key(key) for key in keys],
+            *[redis_cache._serializer.dumps(arg) for arg in args],
+        )
+    )
+
+
+class RunLock:
+    """Make sure a single process runs a job at a time, across hosts.
+
+    The lock is an entry of the default cache (Redis in production) holding a
+    token unique to its owner. It expires after LOCK_TTL unless its owner keeps
+    refreshing it with heartbeat, so a crashed process doesn't hold it forever.
+    """
+
+    def __init__(self, name: str, ttl: int = LOCK_TTL) -> None:
+        self.key = f"run_lock:{name}"
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+
+    def acquire(self) -> bool:
+        """Take the lock if it is free, return whether we hold it."""
+        with _local_lock:
+            return cache.add(self.key, self.token, self.ttl)
+
+    def wait(self, poll_interval: float = WAIT_POLL_INTERVAL) -> None:
+        """Block until the lock is free, then take it."""
+        while not self.acquire():
+            logger.info(f"{self.key} is held by another process, waiting...")
+            time.sleep(poll_interval)
+
+    def heartbeat(self) -> None:
+        """Push back the expiry of the lock, raise RunLockLost if it expired."""
+
+        def touch_if_owner():
+            return cache.get(self.key) == self.token and cache.touch(self.key, self.ttl)
+
+        if not run_atomically(
+            EXPIRE_IF_EQUAL, [self.key], [self.token, self.ttl], touch_if_owner
+        ):
+            raise RunLockLost(f"{self.key} expired")
+
+    async def keep_alive(self, interval: float = HEARTBEAT_INTERVAL) -> None:
+        """Refresh the lock until cancelled, to run alongside the job."""
+        while True:
+            await asyncio.sleep(interval)
+            await sync_to_async(self.heartbeat)()
+
+    def release(self) -> None:
+        """Free the lock, unless it expired and someone else took it."""
+
+        def delete_if_owner():
+            return cache.get(self.key) == self.token and cache.delete(self.key)
+
+        run_atomically(DELETE_IF_EQUAL, [self.key], [self.token], delete_if_owner)
+
+
+class ShardedRunLock:
+    """Make sure a single layout of shards runs a job at a time.
+
+    Each shard of the job has its own RunLock, so the N shards run at the same
+    time while a shard runs once. The job's entry, shared by its shards, holds
+    the number of shards, so a run with another number of shards, updating
+    the same players through other shards, is refused. The entry is deleted
+    with the lock of the last shard, and refreshed by the heartbeat of every
+    shard.
+    """
+
+    def __init__(
+        self, name: str, shard_index: int, shard_count: int, ttl: int = LOCK_TTL
+    ) -> None:
+        self.key = f"run_lock:{name}"
+        self.ttl = ttl
+        self.shard_count = shard_count
+        self.shard_lock = RunLock(f"{name}:{shard_index}/{shard_count}", ttl)
+        # Locks of the shards of the same layout, including this one
+        self.shard_keys = [
+            f"{self.key}:{index}/{shard_count}" for index in range(shard_count)
+        ]
+
+    def _join_job(self) -> bool:
+        """Record our number of shards, return False if it is another one."""
+        with _local_lock:
+            if cache.add(self.key, self.shard_count, self.ttl):
+                return True
+            running_shard_count = cache.get(self.key)
+        if running_shard_count is None:
+            # The job ended in between
+            return self._join_job()
+        if running_shard_count != self.shard_count:
+            logger.info(
+                f"{self.key} is running with {running_shard_count} shards, not"
+                f" {self.shard_count}"
+            )
+            return False
+        return True
+
+    def acquire(self) -> bool:
+        """Take the lock of our shard if the job runs with the same shards."""
+        # The shard lock is taken first, so the job's entry isn't deleted by a
+        # shard ending while we join
+        if not self.shard_lock.acquire():
+            return False
+        if not self._join_job():
+            self.shard_lock.release()
+            return False
+        return True
+
+    def wait(self, poll_interval: float = WAIT_POLL_INTERVAL) -> None:
+        """Block until our shard and the job are free, then take the lock."""
+        while not self.acquire():
+            logger.info(f"{self.shard_lock.key} can't run yet, waiting...")
+            time.sleep(poll_interval)
+
+    def heartbeat(self) -> None:
+        """Refresh our shard lock and the job's entry, see RunLock.heartbeat."""
+        self.shard_lock.heartbeat()
+
+        def touch_if_same_shards():
+            return cache.get(self.key) == self.shard_count and cache.touch(
+                self.key, self.ttl
+            )
+
+        if (
+            not run_atomically(
+                EXPIRE_IF_EQUAL,
+                [self.key],
+                [self.shard_count, self.ttl],
+                touch_if_same_shards,
+            )
+            and not self._join_job()
+        ):
+            raise RunLockLost(f"{self.key} is running with other shards")
+
+    async def keep_alive(self, interval: float = HEARTBEAT_INTERVAL) -> None:
+        """Refresh the lock until cancelled, to run alongside the job."""
+        while True:
+            await asyncio.sleep(interval)
+            await sync_to_async(self.heartbeat)()
+
+    def release(self) -> None:
+        """Free our shard, and the job when no other shard is running."""
+        self.shard_lock.release()
+
+        def delete_if_unused():
+            return (
+                cache.get(self.key) == self.shard_count
+                and not any(cache.has_key(key) for key in self.shard_keys)
+                and cache.delete(self.key)
+            )
+
+        run_atomically(
+            DELETE_IF_EQUAL_AND_UNUSED,
+            [self.key] + self.shard_keys,
+            [self.shard_count],
+            delete_if_unused,
+        )
@@ -0,0 +1,15 @@
+import httpx
+
+API_URL = "https://api.brawlstars.com/v1/"
+
+
+def route_api_responses(responses: dict):
+    """Mock httpx.AsyncClient.get, answering each API path with its payload.
+
+    Requests are made concurrently, so we can't rely on their order.
+    """
+
+    def mocked_get(url, *args, **kwargs):
+        return httpx.Response(200, json=responses[url.replace(API_URL, "")])
+
+    return mocked_get
@@ -0,0 +1,138 @@
+import asyncio
+from unittest import mock
+
+import httpx
+from django.test import SimpleTestCase
+from player_lookup.brawlstars_api import BrawlAPi, RetryBudget, get_retry_delay
+
+
+@mock.patch("player_lookup.brawlstars_api.asyncio.sleep")
+@mock.patch("httpx.AsyncClient.get")
+class BrawlAPiRetryTests(SimpleTestCase):
+    def setUp(self):
+        self.brawl_api = BrawlAPi()
+        self.url = self.brawl_api.get_player_stats_url("#2RQRYV0L")
+
+    async def get(self, retry_budget=None):
+        async with self.brawl_api.session():
+            return await self.brawl_api.get(self.url, retry_budget)
+
+    def test_throttled_request_is_retried(self, mocked_httpx_get, mocked_sleep):
+        mocked_httpx_get.side_effect = [
+            httpx.Response(429, headers={"Retry-After": "2"}),
+            httpx.Response(503),
+            httpx.Response(200, json={"tag": "#2RQRYV0L"}),
+        ]
+        retry_budget = RetryBudget(10)
+        response = asyncio.run(self.get(retry_budget))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(retry_budget.retries_used, 2)
+        # Retry-After is honored, then we fall back to the jittered backoff
+        self.assertIn(mock.call(2.0), mocked_sleep.call_args_list)
+
+    def test_retries_are_bounded_by_budget(self, mocked_httpx_get, mocked_sleep):
+        mocked_httpx_get.return_value = httpx.Response(429)
+        retry_budget = RetryBudget(1)
+        response = asyncio.run(self.get(retry_budget))
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(mocked_httpx_get.call_count, 2)
+        self.assertTrue(retry_budget.exhausted)
+
+    def test_not_found_is_not_retried(self, mocked_httpx_get, mocked_sleep):
+        mocked_httpx_get.return_value = httpx.Response(404)
+        response = asyncio.run(self.get())
+
+        self.assertEqual(response.status_code, 404)
+        mocked_httpx_get.assert_called_once()
+
+
+class GetRetryDelayTests(SimpleTestCase):
+    def test_get_retry_delay(self):
+        self.assertEqual(get_retry_delay(0, "3"), 3)
+        self.assertEqual(get_retry_delay(0, "Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        for attempt in range(10):
+            self.assertLessEqual(get_retry_delay(attempt, None), 30)
+
+
+class BrawlAPiSessionTests(SimpleTestCase):
+    def test_client_is_reused_within_session(self):
+        brawl_api = BrawlAPi()
+
+        async def use_sessions():
+            async with brawl_api.session() as client:
+                async with brawl_api.session() as nested_client:
+                    # Nested sessions share the pooled client
+                    self.assertIs(client, nested_client)
+                    self.assertIs(brawl_api.get_client(), client)
+                # Leaving the nested session doesn't close the pool
+                self.assertFalse(client.is_closed)
+            return client
+
+        client = asyncio.run(use_sessions())
+        self.assertTrue(client.is_closed)
+
+
+class GetClubBatchMembersTests(SimpleTestCase):
+    def test_concurrency_is_capped_and_failures_are_isolated(self):
+        brawl_api = BrawlAPi()
+        in_flight = 0
+        max_in_flight = 0
+
+        async def get_club_members(club_tag, retry_budget=None):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            if club_tag == "#DOWN":
+                # Network error, after all its retries
+                return {"reason": "ConnectError"}
+            if club_tag == "#NOTFOUND":
+                return {"reason": "notFound"}
+            return {"items": [{"tag": f"{club_tag}MEMBER"}]}
+
+        club_tags = [f"#CLUB{index}" for index in range(10)] + ["#DOWN", "#NOTFOUND"]
+        with mock.patch.object(brawl_api, "get_club_members", get_club_members):
+            club_members = asyncio.run(
+                brawl_api.get_club_batch_members(club_tags, concurrency=3)
+            )
+
+        self.assertEqual(max_in_flight, 3)
+        self.assertEqual(
+            club_members,
+            {f"#CLUB{index}": [{"tag": f"#CLUB{index}MEMBER"}] for index in range(10)},
+        )
+
+
+@mock.patch("player_lookup.brawlstars_api.asyncio.sleep")
+@mock.patch("httpx.AsyncClient.get")
+class GetClubMembersTagListTests(SimpleTestCase):
+    def get_club_members_tag_list(self):
+        brawl_api = BrawlAPi()
+
+        async def get_tags():
+            async with brawl_api.session():
+                return await brawl_api.get_club_members_tag_list("#P0GVGVRP")
+
+        return asyncio.run(get_tags())
+
+    def test_members_tags(self, mocked_httpx_get, mocked_sleep):
+        mocked_httpx_get.return_value = httpx.Response(
+            200, json={"items": [{"tag": "#2RQRYV0L"}, {"tag": "#9090YYGQ"}]}
+        )
+        self.assertEqual(self.get_club_members_tag_list(), ["#2RQRYV0L", "#9090YYGQ"])
+
+    def test_unavailable_members(self, mocked_httpx_get, mocked_sleep):
+        for failure in (
+            httpx.Response(404, json={"reason": "notFound"}),
+            httpx.Response(429, json={"reason": "throttled"}),
+            httpx.Response(503, text="<html>Service Unavailable</html>"),
+            httpx.ConnectError("Connection refused"),
+        ):
+            if isinstance(failure, Exception):
+                mocked_httpx_get.side_effect = failure
+            else:
+                mocked_httpx_get.return_value = failure
+            self.assertEqual(self.get_club_members_tag_list(), [])
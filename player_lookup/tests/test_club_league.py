@@ -0,0 +1,62 @@
+from datetime import date, timedelta
+from django.test import SimpleTestCase
+from player_lookup import club_league
+
+
+class ClubLeagueCalendarTests(SimpleTestCase):
+    def setUp(self):
+        self.calendar = club_league.ClubLeagueCalendar(date(2019, 12, 4))
+        # Several years, including ISO years with 53 weeks (2020, 2026)
+        self.days = [
+            date(2019, 12, 4) + timedelta(days=offset) for offset in range(365 * 8)
+        ]
+
+    def test_same_as_day_by_day_rules(self):
+        for day in self.days:
+            self.assertEqual(
+                self.calendar.is_running(day), club_league.is_club_league_day(day), day
+            )
+
+    def test_cumulative_counts(self):
+        first_day = date(2022, 7, 1)
+        club_league_days = 0
+        for day in self.days:
+            if day < first_day:
+                continue
+            club_league_days += self.calendar.is_running(day)
+            self.assertEqual(
+                self.calendar.count_club_league_days(first_day, day), club_league_days
+            )
+        self.assertEqual(
+            self.calendar.count_club_league_days(date(2022, 7, 2), date(2022, 7, 1)), 0
+        )
+
+    def test_club_league_weeks(self):
+        wednesdays = [day for day in self.days if day.weekday() == 2]
+        club_league_weeks = 0
+        for wednesday in wednesdays:
+            club_league_weeks += (
+                self.calendar.count_club_league_days(
+                    wednesday, wednesday + timedelta(days=5)
+                )
+                >= 5
+            )
+            self.assertEqual(
+                self.calendar.count_club_league_weeks(wednesdays[0], wednesday),
+                club_league_weeks,
+            )
+
+    def test_bounds(self):
+        with self.assertRaises(ValueError):
+            club_league.ClubLeagueCalendar(date(2019, 12, 5))
+        with self.assertRaises(ValueError):
+            self.calendar.is_running(date(2019, 12, 3))
+
+        self.assertIsNone(self.calendar.last_day)
+        self.calendar.is_running(date(2022, 7, 6))
+        # Extended ahead of the queried day, in whole weeks
+        self.assertGreaterEqual(
+            self.calendar.last_day,
+            date(2022, 7, 6) + club_league.CALENDAR_EXTENSION,
+        )
+        self.assertEqual(self.calendar.last_day.weekday(), 1)
@@ -0,0 +1,119 @@
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from player_lookup import match_types
+from player_lookup.models import (
+    Brawler,
+    BrawlMap,
+    ClubLeagueCounters,
+    Match,
+    MatchIssue,
+    Player,
+    count_club_league_matches,
+    rebuild_club_league_counters,
+)
+
+
+class GetMatchTypeTests(SimpleTestCase):
+    def setUp(self):
+        match_types.unknown_match_types.clear()
+
+    def test_get_match_type(self):
+        self.assertEqual(match_types.get_match_type("WIN", 9), (True, True))
+        self.assertEqual(match_types.get_match_type("WIN", 7), (True, False))
+        self.assertEqual(match_types.get_match_type("LOSS", 2), (False, True))
+        self.assertEqual(match_types.get_match_type("DRAW", 2), (False, False))
+
+        # Unknown combinations are counted instead of being guessed
+        self.assertIsNone(match_types.get_match_type("WIN", 8))
+        self.assertIsNone(match_types.get_match_type("WIN", 8))
+        self.assertIsNone(match_types.get_match_type("UNKNOWN", 3))
+        self.assertEqual(
+            match_types.unknown_match_types,
+            {("WIN", 8): 2, ("UNKNOWN", 3): 1},
+        )
+
+    def test_vectorized_get_match_types(self):
+        combinations = list(match_types.MATCH_TYPES) + [
+            ("WIN", 8),
+            ("WIN", -1),
+            ("LOSS", 100),
+            ("UNKNOWN", 3),
+        ]
+        outcomes, trophies_won = zip(*combinations)
+        known, is_power_match, played_with_clubmate = match_types.get_match_types(
+            outcomes, trophies_won
+        )
+        for index, (outcome, trophies) in enumerate(combinations):
+            match_type = match_types.get_match_type(outcome, trophies)
+            self.assertEqual(known[index], match_type is not None)
+            self.assertEqual(
+                (is_power_match[index], played_with_clubmate[index]),
+                match_type or (False, False),
+            )
+
+
+class ReclassifyMatchesTests(TestCase):
+    def test_reclassify_matches(self):
+        player = Player.objects.create(player_tag="#PLAYER", player_name="Player")
+        brawler = Brawler.objects.create(name="SHELLY")
+        brawl_map = BrawlMap.objects.create(name="Hard Rock Mine")
+        for match_id, outcome, trophies_won in (
+            ("power", "WIN", 9),
+            ("normal", "LOSS", 1),
+            ("unknown", "WIN", 8),
+            ("classified", "WIN", 3),
+        ):
+            match = Match.objects.create(
+                match_id=match_id,
+                mode="gemGrab",
+                map_played=brawl_map,
+                # Misclassified on purpose, or saved before its type was known
+                battle_type={9: "Normal Match", 1: "Power Match"}.get(
+                    trophies_won, match_types.UNKNOWN_MATCH
+                ),
+                date="2022-10-26T12:00:00Z",
+            )
+            MatchIssue.objects.create(
+                match=match,
+                player=player,
+                brawler=brawler,
+                outcome=outcome,
+                trophies_won=trophies_won,
+                played_with_clubmate=trophies_won == 1,
+            )
+
+        # Only its match changes type, in the batch of the first player's issue
+        other_player = Player.objects.create(player_tag="#OTHER", player_name="Other")
+        MatchIssue.objects.create(
+            match_id="power",
+            player=other_player,
+            brawler=brawler,
+            outcome="WIN",
+            trophies_won=9,
+            played_with_clubmate=True,
+        )
+        Player.objects.update(default_date="2022-01-01T00:00:00Z")
+        players = list(Player.objects.all())
+        rebuild_club_league_counters(players)
+
+        call_command("reclassify_matches", "--batch-size", "2")
+
+        # The counters count the new types
+        counts = count_club_league_matches(players)
+        self.assertEqual(counts["#OTHER"]["power_match"], 1)
+        for counters in ClubLeagueCounters.objects.all():
+            self.assertEqual(counters.get_counts(), counts[counters.player_id])
+
+        self.assertEqual(
+            dict(Match.objects.values_list("match_id", "battle_type")),
+            {
+                "power": "Power Match",
+                "normal": "Normal Match",
+                "unknown": match_types.UNKNOWN_MATCH,
+                "classified": "Normal Match",
+            },
+        )
+        self.assertEqual(
+            dict(MatchIssue.objects.values_list("match_id", "played_with_clubmate")),
+            {"power": True, "normal": False, "unknown": False, "classified": False},
+        )
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta, timezone
+
+from django.test import TestCase
+from player_lookup.models import (
+    Brawler,
+    BrawlMap,
+    Match,
+    MatchIssue,
+    Player,
+    update_player_batch_remaining_tickets,
+)
+
+
+class RemainingTicketsTests(TestCase):
+    def setUp(self):
+        self.club_league_day_start = datetime(2022, 10, 26, tzinfo=timezone.utc)
+        brawler = Brawler.objects.create(name="SHELLY")
+        brawl_map = BrawlMap.objects.create(name="Hard Rock Mine")
+        self.players = [
+            Player.objects.create(player_tag=f"#PLAYER{index}", player_name="Player")
+            for index in range(3)
+        ]
+        # Player 0 played a power match and a normal match today, and a match
+        # the day before. Player 1 played a normal match, player 2 didn't play.
+        for match_id, player, battle_type, days in (
+            ("power", self.players[0], "Power Match", 0),
+            ("normal", self.players[0], "Normal Match", 0),
+            ("yesterday", self.players[0], "Normal Match", -1),
+            ("other", self.players[1], "Normal Match", 0),
+        ):
+            match = Match.objects.create(
+                match_id=match_id,
+                mode="gemGrab",
+                map_played=brawl_map,
+                battle_type=battle_type,
+                date=self.club_league_day_start + timedelta(days=days, hours=1),
+            )
+            MatchIssue.objects.create(match=match, player=player, brawler=brawler)
+
+    def test_update_player_batch_remaining_tickets(self):
+        with self.assertNumQueries(1):
+            updated_players = update_player_batch_remaining_tickets(
+                self.players, 4, self.club_league_day_start
+            )
+        self.assertEqual(updated_players, self.players)
+        self.assertEqual(
+            [player.number_of_available_tickets for player in updated_players],
+            [1, 3, 4],
+        )
@@ -0,0 +1,52 @@
+import asyncio
+from unittest import mock
+
+from django.test import SimpleTestCase
+from player_lookup.rate_limiter import ApiKeyPool
+
+
+class ApiKeyPoolTests(SimpleTestCase):
+    @mock.patch("player_lookup.rate_limiter.time.monotonic")
+    def test_least_loaded_key_is_used(self, mocked_monotonic):
+        mocked_monotonic.return_value = 0
+        pool = ApiKeyPool(["key_a", "key_b"], [1, 1], [2, 3])
+
+        # key_b has the fullest bucket, then both keys are used in turn
+        self.assertEqual(pool.acquire_sync(), "key_b")
+        self.assertEqual(pool.acquire_sync(), "key_a")
+        self.assertEqual(pool.acquire_sync(), "key_b")
+        self.assertEqual(pool.acquire_sync(), "key_a")
+        self.assertEqual(pool.acquire_sync(), "key_b")
+
+        # Every bucket is empty, we have to wait for a refill
+        api_key, wait_time = pool._try_acquire()
+        self.assertIsNone(api_key)
+        self.assertEqual(wait_time, 1)
+
+        mocked_monotonic.return_value = 1
+        self.assertIsNotNone(pool.acquire_sync())
+
+    @mock.patch("player_lookup.rate_limiter.asyncio.sleep")
+    @mock.patch("player_lookup.rate_limiter.time.monotonic")
+    def test_acquire_waits_for_a_token(self, mocked_monotonic, mocked_sleep):
+        mocked_monotonic.return_value = 0
+        pool = ApiKeyPool(["key_a"], [2], [1])
+        asyncio.run(pool.acquire())
+
+        async def fake_sleep(delay):
+            mocked_monotonic.return_value += delay
+
+        mocked_sleep.side_effect = fake_sleep
+        self.assertEqual(asyncio.run(pool.acquire()), "key_a")
+        mocked_sleep.assert_called_once_with(0.5)
+
+    def test_shard_splits_the_keys(self):
+        pool = ApiKeyPool(["key_a", "key_b", "key_c"], [10, 10, 10], [20, 20, 20])
+        self.assertEqual(pool.shard(0, 2).api_keys, ["key_a", "key_c"])
+        self.assertEqual(pool.shard(1, 2).api_keys, ["key_b"])
+
+        # Not enough keys for each worker to have its own, they share the quota
+        shared_pool = pool.shard(0, 4)
+        self.assertEqual(shared_pool.api_keys, ["key_a", "key_b", "key_c"])
+        self.assertEqual(shared_pool._buckets["key_a"].rate, 2.5)
+        self.assertEqual(shared_pool._buckets["key_a"].burst, 5)
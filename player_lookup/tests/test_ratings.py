@@ -0,0 +1,73 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+from django.test import TestCase
+from freezegun import freeze_time
+from player_lookup.models import Brawler, BrawlMap, Match, MatchIssue, Player
+from player_lookup.ratings import update_batch_brawlclub_ratings
+
+RATING_FIELDS = (
+    "brawlclub_rating",
+    "club_league_winrate",
+    "club_league_playrate",
+    "club_league_teamplay_rate",
+)
+
+
+class BatchBrawlclubRatingTests(TestCase):
+    def setUp(self):
+        rng = random.Random(42)
+        brawler = Brawler.objects.create(name="SHELLY")
+        brawl_map = BrawlMap.objects.create(name="Hard Rock Mine")
+        first_day = datetime(2022, 9, 1, tzinfo=timezone.utc)
+        matches = [
+            Match.objects.create(
+                match_id=f"match{index}",
+                mode="gemGrab",
+                map_played=brawl_map,
+                battle_type=rng.choice(["Power Match", "Normal Match"]),
+                date=first_day + timedelta(hours=rng.randrange(24 * 60)),
+            )
+            for index in range(40)
+        ]
+        for index in range(20):
+            player = Player.objects.create(
+                player_tag=f"#PLAYER{index}",
+                player_name="Player",
+                # Some players are under the trophies needed to have a club
+                trophy_count=rng.choice([500, 1000, 20000]),
+                brawlclub_rating=-1,
+            )
+            # Players were added at different dates, some matches are older
+            Player.objects.filter(pk=player.pk).update(
+                default_date=first_day + timedelta(hours=rng.randrange(24 * 40))
+            )
+            for match in rng.sample(matches, rng.randrange(15)):
+                MatchIssue.objects.create(
+                    match=match,
+                    player=player,
+                    brawler=brawler,
+                    outcome=rng.choice(["WIN", "LOSS", "DRAW"]),
+                    played_with_clubmate=rng.random() < 0.5,
+                )
+
+    @freeze_time("2022-11-02 12:00:00")
+    def test_same_ratings_as_update_brawlclub_rating(self):
+        expected_players = list(Player.objects.order_by("player_tag"))
+        for player in expected_players:
+            player.update_brawlclub_rating(save=False)
+
+        players = list(Player.objects.order_by("player_tag"))
+        with self.assertNumQueries(1):
+            update_batch_brawlclub_ratings(players)
+
+        for player, expected_player in zip(players, expected_players):
+            for field in RATING_FIELDS:
+                self.assertEqual(
+                    getattr(player, field),
+                    getattr(expected_player, field),
+                    f"{player.player_tag} {field}",
+                )
+        # Players under 900 trophies are left untouched
+        self.assertIn(-1, [player.brawlclub_rating for player in players])
+        self.assertTrue(any(player.brawlclub_rating > 0 for player in players))
@@ -0,0 +1,94 @@
+import asyncio
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+from player_lookup import run_lock
+from player_lookup.run_lock import RunLock, RunLockLost, ShardedRunLock
+
+
+class RunLockTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_lock_is_held_by_a_single_owner(self):
+        first_lock = RunLock("job")
+        second_lock = RunLock("job")
+        self.assertTrue(first_lock.acquire())
+        self.assertFalse(second_lock.acquire())
+
+        # Only the owner can release the lock
+        second_lock.release()
+        self.assertFalse(second_lock.acquire())
+        first_lock.release()
+        self.assertTrue(second_lock.acquire())
+
+    def test_heartbeat_detects_lost_lock(self):
+        lock = RunLock("job")
+        lock.acquire()
+        lock.heartbeat()
+
+        # The lock expired and another process took it
+        cache.delete(lock.key)
+        RunLock("job").acquire()
+        with self.assertRaises(RunLockLost):
+            lock.heartbeat()
+        with self.assertRaises(RunLockLost):
+            asyncio.run(lock.keep_alive(interval=0))
+
+    @mock.patch("player_lookup.run_lock.time.sleep")
+    def test_wait_for_the_lock(self, mocked_sleep):
+        running_lock = RunLock("job")
+        running_lock.acquire()
+        mocked_sleep.side_effect = lambda delay: running_lock.release()
+
+        lock = RunLock("job")
+        lock.wait()
+        mocked_sleep.assert_called_once()
+        self.assertEqual(cache.get(lock.key), lock.token)
+
+    @mock.patch("player_lookup.run_lock.cache")
+    def test_heartbeat_is_a_single_step_on_redis(self, mocked_cache):
+        lock = RunLock("job")
+        redis_client = mocked_cache._cache.get_client.return_value
+        redis_client.eval.return_value = 0
+        with self.assertRaises(RunLockLost):
+            lock.heartbeat()
+        script, number_of_keys, key, _token, _ttl = redis_client.eval.call_args.args
+        self.assertEqual(script, run_lock.EXPIRE_IF_EQUAL)
+        self.assertEqual(number_of_keys, 1)
+        self.assertEqual(key, mocked_cache.make_key.return_value)
+        mocked_cache.make_key.assert_called_once_with(lock.key)
+        mocked_cache.touch.assert_not_called()
+
+
+class ShardedRunLockTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_shards_of_the_same_layout_run_together(self):
+        first_shard = ShardedRunLock("job", 0, 2)
+        second_shard = ShardedRunLock("job", 1, 2)
+        self.assertTrue(first_shard.acquire())
+        self.assertTrue(second_shard.acquire())
+        # A shard runs once
+        self.assertFalse(ShardedRunLock("job", 1, 2).acquire())
+        # Other layouts are refused while a shard runs
+        self.assertFalse(ShardedRunLock("job", 0, 1).acquire())
+        self.assertFalse(ShardedRunLock("job", 2, 3).acquire())
+        first_shard.heartbeat()
+
+        first_shard.release()
+        self.assertFalse(ShardedRunLock("job", 0, 1).acquire())
+        second_shard.release()
+        self.assertTrue(ShardedRunLock("job", 0, 1).acquire())
+
+    def test_heartbeat_detects_other_layout(self):
+        lock = ShardedRunLock("job", 0, 2)
+        lock.acquire()
+        # The job's entry expired and another layout took it
+        cache.delete(lock.key)
+        lock.heartbeat()
+        cache.set(lock.key, 1)
+        with self.assertRaises(RunLockLost):
+            lock.heartbeat()
@@ -0,0 +1,244 @@
+import json
+from pathlib import Path
+from unittest import mock
+
+import requests
+
+from django.test import TestCase
+from player_lookup import models
+from player_lookup.match_types import UNKNOWN_MATCH
+from player_lookup.models import (
+    Brawler,
+    BrawlMap,
+    Club,
+    ClubLeagueCounters,
+    Match,
+    MatchIssue,
+    Player,
+    count_club_league_matches,
+    get_club_league_counters,
+    rebuild_club_league_counters,
+)
+from player_lookup.update_services import (
+    MatchRegistry,
+    NameIndex,
+    create_matches_from_battlelog,
+    create_or_update_club,
+    get_battlelogs_names,
+    get_match_id,
+    is_club_league_battle,
+)
+
+TEST_DATA_DIR = Path(__file__).parent / "test_data"
+
+
+class MatchRegistryTests(TestCase):
+    def setUp(self):
+        self.tag_battlelog = {}
+        for tag in ("#9090YYGQ", "#2RQRYV0L"):
+            Player.objects.create(player_tag=tag, player_name=f"Player {tag}")
+            with open(TEST_DATA_DIR / f"test_player_{tag[1:]}_battlelog.json") as f:
+                self.tag_battlelog[tag] = json.load(f)
+
+        # The club league match of #9090YYGQ is already saved
+        battle = next(
+            battle
+            for battle in self.tag_battlelog["#9090YYGQ"]["items"]
+            if is_club_league_battle(battle)
+        )
+        self.match = Match.objects.create(
+            match_id=get_match_id(battle),
+            mode="gemGrab",
+            map_played=BrawlMap.objects.create(name="Hard Rock Mine"),
+            battle_type="Power Match",
+            date="2022-10-27T21:48:34Z",
+        )
+        MatchIssue.objects.create(
+            match=self.match,
+            player_id="#9090YYGQ",
+            brawler=Brawler.objects.create(name="SHELLY"),
+        )
+
+    def test_saved_matches_are_skipped_without_queries(self):
+        all_brawlers = NameIndex(Brawler)
+        all_maps = NameIndex(BrawlMap)
+        brawler_names, map_names = get_battlelogs_names(self.tag_battlelog.values())
+        all_brawlers.add_missing(brawler_names)
+        all_maps.add_missing(map_names)
+
+        for _ in range(2):
+            registry = MatchRegistry()
+            with self.assertNumQueries(0):
+                for tag, battlelog in self.tag_battlelog.items():
+                    create_matches_from_battlelog(
+                        tag, battlelog, all_brawlers, all_maps, registry
+                    )
+            registry.save()
+
+            # Ingesting the same battlelogs again doesn't duplicate anything
+            self.assertEqual(Match.objects.count(), 2)
+            self.assertEqual(MatchIssue.objects.count(), 2)
+            self.assertEqual(
+                MatchIssue.objects.get(player_id="#9090YYGQ").brawler.name, "SHELLY"
+            )
+
+    def test_shared_match_is_built_once_per_batch(self):
+        shared_match_id = self.match.match_id
+        self.match.delete()
+        # Both players were in the club league match of #9090YYGQ
+        shared_battle = next(
+            battle
+            for battle in self.tag_battlelog["#9090YYGQ"]["items"]
+            if is_club_league_battle(battle)
+        )
+        self.tag_battlelog["#2RQRYV0L"]["items"].append(shared_battle)
+
+        registry = MatchRegistry()
+        for tag, battlelog in self.tag_battlelog.items():
+            create_matches_from_battlelog(tag, battlelog, match_registry=registry)
+        self.assertEqual(len(registry.new_matches), 2)
+        self.assertEqual(len(registry.new_match_issues), 3)
+        self.assertFalse(Match.objects.exists())
+
+        # A single insert for the matches and one for the match issues, the
+        # creation and the lock of the counters, the lookup of the saved match
+        # issues, within a savepoint
+        with self.assertNumQueries(7):
+            self.assertEqual(registry.save(), 3)
+        self.assertEqual(Match.objects.count(), 2)
+        self.assertEqual(MatchIssue.objects.filter(match_id=shared_match_id).count(), 2)
+
+    def test_unknown_match_types_are_saved_unclassified(self):
+        self.match.delete()
+        battle = next(
+            battle
+            for battle in self.tag_battlelog["#9090YYGQ"]["items"]
+            if is_club_league_battle(battle)
+        )
+        # Trophies won that MATCH_TYPES doesn't know
+        battle["battle"]["trophyChange"] = 8
+
+        registry = MatchRegistry()
+        create_matches_from_battlelog(
+            "#9090YYGQ", self.tag_battlelog["#9090YYGQ"], match_registry=registry
+        )
+        self.assertEqual(registry.save(), 1)
+        match_issue = MatchIssue.objects.select_related("match").get(
+            player_id="#9090YYGQ"
+        )
+        self.assertEqual(match_issue.match.battle_type, UNKNOWN_MATCH)
+        self.assertEqual(match_issue.trophies_won, 8)
+        self.assertFalse(match_issue.played_with_clubmate)
+
+    def test_new_match_issues_are_counted(self):
+        self.match.delete()
+        # Counted since before the battles of the test data
+        Player.objects.update(default_date="2022-10-26T00:00:00Z")
+        players = list(Player.objects.order_by("player_tag"))
+        counters = get_club_league_counters(players)
+        self.assertEqual(counters["#9090YYGQ"]["all_matches_count"], 0)
+
+        for _ in range(2):
+            registry = MatchRegistry()
+            for tag, battlelog in self.tag_battlelog.items():
+                create_matches_from_battlelog(tag, battlelog, match_registry=registry)
+            registry.save()
+
+            # Saving the same match issues again doesn't count them twice
+            with self.assertNumQueries(1):
+                # Up to date, not rebuilt
+                counters = get_club_league_counters(players)
+            self.assertEqual(counters["#9090YYGQ"]["all_matches_count"], 1)
+            self.assertEqual(
+                counters,
+                {
+                    player.player_tag: count_club_league_matches(players)[
+                        player.player_tag
+                    ]
+                    for player in players
+                },
+            )
+
+    def test_save_interleaved_with_rebuild(self):
+        self.match.delete()
+        Player.objects.update(default_date="2022-10-26T00:00:00Z")
+        players = list(Player.objects.order_by("player_tag"))
+        get_club_league_counters(players)
+        registries = []
+        for tag, battlelog in self.tag_battlelog.items():
+            registry = MatchRegistry()
+            create_matches_from_battlelog(tag, battlelog, match_registry=registry)
+            registries.append(registry)
+        events = []
+        original_lock = models.lock_club_league_counters
+        original_count = models.count_club_league_matches
+
+        def lock(player_tags):
+            events.append("lock")
+            return original_lock(player_tags)
+
+        def count(players):
+            events.append("count")
+            # The latest a save of another process can commit, it waits for
+            # the lock taken by the rebuild otherwise
+            registries[0].save()
+            return original_count(players)
+
+        with mock.patch.object(
+            models, "lock_club_league_counters", side_effect=lock
+        ), mock.patch.object(models, "count_club_league_matches", side_effect=count):
+            rebuild_club_league_counters(players)
+        # The rebuild locked the counters before counting, then the save did
+        self.assertEqual(events, ["lock", "count", "lock"])
+        # A save once the rebuild committed increments the rebuilt counters
+        registries[1].save()
+        # Rebuilding again updates the counters in place
+        rebuild_club_league_counters(players)
+        registries[1].save()
+
+        counts = count_club_league_matches(players)
+        self.assertEqual(counts["#9090YYGQ"]["all_matches_count"], 1)
+        self.assertEqual(
+            {
+                counters.player_id: counters.get_counts()
+                for counters in ClubLeagueCounters.objects.all()
+            },
+            counts,
+        )
+
+
+class NameIndexTests(TestCase):
+    def test_missing_names_are_created_at_once(self):
+        with open(TEST_DATA_DIR / "test_player_9090YYGQ_battlelog.json") as f:
+            battlelog = json.load(f)
+        brawler_names, map_names = get_battlelogs_names([battlelog])
+        self.assertEqual(len(brawler_names), 6)
+        self.assertEqual(len(map_names), 1)
+
+        Brawler.objects.create(name="SHELLY")
+        all_brawlers = NameIndex(Brawler)
+        with self.assertNumQueries(3):
+            # Reloads the index, inserts the missing brawlers and reloads again
+            all_brawlers.add_missing(brawler_names)
+        self.assertEqual(Brawler.objects.count(), len(brawler_names | {"SHELLY"}))
+        with self.assertNumQueries(0):
+            for name in brawler_names:
+                self.assertEqual(all_brawlers.get_or_create(name).name, name)
+
+    def test_names_created_by_another_process_are_found(self):
+        all_maps = NameIndex(BrawlMap)
+        new_map = BrawlMap.objects.create(name="New Map")
+        self.assertEqual(all_maps.get_or_create("New Map"), new_map)
+        self.assertEqual(BrawlMap.objects.count(), 1)
+
+
+class CreateOrUpdateClubTests(TestCase):
+    @mock.patch("player_lookup.update_services.brawl_api.get_club_information")
+    def test_unavailable_club(self, mocked_get_club_information):
+        mocked_get_club_information.return_value = {"reason": "notFound"}
+        self.assertIsNone(create_or_update_club("#UNKNOWN"))
+
+        club = Club.objects.create(club_tag="#SAVED", club_name="Saved")
+        mocked_get_club_information.side_effect = requests.ConnectionError()
+        self.assertEqual(create_or_update_club("#SAVED"), club)
+        self.assertEqual(Club.objects.get().club_name, "Saved")
@@ -1,7 +1,9 @@
+import random
 from datetime import datetime, timezone, timedelta
 from django.test import TestCase
 from freezegun import freeze_time
 from player_lookup import utils
+from player_lookup.models import Player
 
 
 """
@@ -265,3 +267,130 @@ class GetClubLeagueStatusTests(TestCase):
         with freeze_time("2022-11-02"):
             # No tickets are available at this point
             self.assertEqual(utils.get_this_weeks_number_of_remaining_tickets(), 0)
+
+
+class ReferenceDateTests(TestCase):
+    def test_reference_date_is_the_same_as_frozen_time(self):
+        calendar_functions = (
+            utils.get_club_league_status,
+            utils.get_this_weeks_number_of_available_tickets,
+            utils.get_this_weeks_number_of_remaining_tickets,
+            utils.get_today_number_of_remaining_tickets,
+            utils.get_last_club_league_day_start,
+        )
+        # 4 club leagues, including the change of year
+        first_day = datetime(2022, 12, 5, 15, tzinfo=timezone.utc)
+        for offset in range(56):
+            reference_date = first_day + timedelta(days=offset)
+            with freeze_time(reference_date):
+                expected_values = [function() for function in calendar_functions]
+            self.assertEqual(
+                [function(reference_date) for function in calendar_functions],
+                expected_values,
+                reference_date,
+            )
+            self.assertEqual(
+                [function(reference_date.date()) for function in calendar_functions],
+                expected_values,
+            )
+
+
+def get_number_of_weeks_since_date_by_day(since: datetime, today: datetime) -> int:
+    """Day by day implementation get_number_of_weeks_since_date used to have."""
+    today = today.replace(hour=0, minute=0, second=0, microsecond=0)
+    club_league_days = 0
+    club_league_weeks = 0
+    for _date in utils.daterange(since, today):
+        if (_date.isocalendar()[1] % 2 != 0 and _date.weekday() not in (0, 1)) or (
+            _date.isocalendar()[1] % 2 == 0 and _date.weekday() == 0
+        ):
+            club_league_days += 1
+        if _date.weekday() == 1:
+            if club_league_days // 5 > 0:
+                club_league_weeks += 1
+            club_league_days = 0
+
+    return club_league_weeks
+
+
+class NumberOfWeeksSinceDateTests(TestCase):
+    def test_same_as_day_by_day_count(self):
+        rng = random.Random(0)
+        # Several years, including ISO years with 53 weeks (2020, 2026)
+        first_day = datetime(2019, 12, 1, tzinfo=timezone.utc)
+        for since_offset in range(0, 365 * 8, 3):
+            since = first_day + timedelta(
+                days=since_offset, hours=rng.choice([0, 0, 13])
+            )
+            for _ in range(3):
+                today = since + timedelta(
+                    days=rng.randrange(-3, 365 * 2), hours=rng.randrange(24)
+                )
+                self.assertEqual(
+                    utils.get_number_of_weeks_since_date(since, today),
+                    get_number_of_weeks_since_date_by_day(since, today),
+                    f"since {since}, today {today}",
+                )
+
+
+class KeysetBatchesTests(TestCase):
+    def setUp(self):
+        last_updated = datetime(2022, 10, 26, tzinfo=timezone.utc)
+        # Same ratings and NULL dates are the tricky cases of keyset pagination
+        for index in range(10):
+            Player.objects.create(
+                player_tag=f"#TAG{index}",
+                player_name=f"Player {index}",
+                brawlclub_rating=index % 3,
+                last_updated=None if index % 2 else last_updated,
+            )
+        self.ordering = ("-brawlclub_rating", "last_updated", "player_tag")
+
+    def test_keyset_batches_match_ordered_queryset(self):
+        expected_tags = list(
+            Player.objects.order_by(
+                *utils.get_keyset_ordering(self.ordering)
+            ).values_list("player_tag", flat=True)
+        )
+        batched_tags = []
+        for batch, position in utils.keyset_batches(
+            Player.objects.all(), self.ordering, 3
+        ):
+            self.assertLessEqual(len(batch), 3)
+            self.assertEqual(position, batch[-1])
+            batched_tags.extend(row[-1] for row in batch)
+
+        self.assertEqual(batched_tags, expected_tags)
+
+    def test_keyset_batches_with_rows_leaving_the_queryset(self):
+        # Updated players leave the queryset, no player is skipped nor repeated
+        queryset = Player.objects.filter(trophy_count=0)
+        batched_tags = []
+        for batch, _ in utils.keyset_batches(queryset, self.ordering, 4):
+            tags = [row[-1] for row in batch]
+            Player.objects.filter(player_tag__in=tags).update(trophy_count=1)
+            batched_tags.extend(tags)
+
+        self.assertEqual(sorted(batched_tags), [f"#TAG{index}" for index in range(10)])
+
+    def test_keyset_batches_resume_from_position(self):
+        batches = list(utils.keyset_batches(Player.objects.all(), self.ordering, 4))
+        _, position = batches[0]
+        resumed_batches = list(
+            utils.keyset_batches(Player.objects.all(), self.ordering, 4, position)
+        )
+        self.assertEqual(resumed_batches, batches[1:])
+
+
+class ParseBattleTimeTests(TestCase):
+    def test_parse_battle_time(self):
+        battle_date, timestamp = utils.parse_battle_time("20221130T125400.250Z")
+        self.assertEqual(
+            battle_date,
+            datetime(2022, 11, 30, 12, 54, 0, 250000, tzinfo=timezone.utc),
+        )
+        # Epoch seconds don't depend on the local timezone
+        self.assertEqual(timestamp, 1669812840)
+
+        with self.assertRaises(ValueError):
+            utils.parse_battle_time("2022-11-30T12:54:00Z")
@@ -1,16 +1,32 @@
 import json
+from datetime import datetime, timezone
 from pathlib import Path
 from unittest import mock
 
 import httpx
+from django.core.cache import cache
 from django.core.management import call_command
 from django.test import TestCase
 from freezegun import freeze_time
-from player_lookup.models import Club, MatchIssue, Player, PlayerHistory, Match
+from player_lookup.models import (
+    Brawler,
+    BrawlMap,
+    Club,
+    ClubLeagueCounters,
+    Match,
+    MatchIssue,
+    Player,
+    PlayerHistory,
+    PlayersUpdate,
+)
+from player_lookup.management.commands import update_all_players
+from player_lookup.run_lock import ShardedRunLock
+from player_lookup.tests.helpers import route_api_responses
 
 
 class UpdateAllPlayersTests(TestCase):
     def setUp(self):
+        cache.clear()
         self.player_9090YYGQ = Player.objects.create(
             player_tag="#9090YYGQ",
             player_name="Player 9090YYGQ",
@@ -52,13 +68,15 @@ class UpdateAllPlayersTests(TestCase):
         mocked_httpx_get,
     ):
         mocked_club_league_status.return_value = True
-        mocked_httpx_get.side_effect = [
-            httpx.Response(200, json=self.player_data_9090YYGQ),
-            httpx.Response(200, json=self.player_data_2RQRYV0L),
-            httpx.Response(200, json=self.player_battlelog_9090YYGQ),
-            httpx.Response(200, json=self.player_battlelog_2RQRYV0L),
-            httpx.Response(200, json=self.club_data_P0GVGVRP),
-        ]
+        mocked_httpx_get.side_effect = route_api_responses(
+            {
+                "players/%239090YYGQ": self.player_data_9090YYGQ,
+                "players/%232RQRYV0L": self.player_data_2RQRYV0L,
+                "players/%239090YYGQ/battlelog": self.player_battlelog_9090YYGQ,
+                "players/%232RQRYV0L/battlelog": self.player_battlelog_2RQRYV0L,
+                "clubs/%23P0GVGVRP": self.club_data_P0GVGVRP,
+            }
+        )
         call_command("update_all_players", "--force")
         self.player_9090YYGQ.refresh_from_db()
         self.player_2RQRYV0L.refresh_from_db()
@@ -70,6 +88,331 @@ class UpdateAllPlayersTests(TestCase):
         mocked_club_league_status.return_value = False
         call_command("update_all_players")
 
+    @mock.patch("player_lookup.brawlstars_api.get_retry_delay", return_value=0)
+    @mock.patch("httpx.AsyncClient.get")
+    @mock.patch("player_lookup.utils.get_club_league_status")
+    @freeze_time("2022-10-26", tick=True)
+    def test_unreachable_player_doesnt_stop_the_run(
+        self,
+        mocked_club_league_status,
+        mocked_httpx_get,
+        mocked_retry_delay,
+    ):
+        mocked_club_league_status.return_value = False
+        route = route_api_responses(
+            {
+                "players/%239090YYGQ": self.player_data_9090YYGQ,
+                "players/%239090YYGQ/battlelog": self.player_battlelog_9090YYGQ,
+                "clubs/%23P0GVGVRP": self.club_data_P0GVGVRP,
+            }
+        )
+
+        def mocked_get(url, *args, **kwargs):
+            if "2RQRYV0L" in url:
+                raise httpx.ReadTimeout("Timed out")
+            return route(url, *args, **kwargs)
+
+        mocked_httpx_get.side_effect = mocked_get
+        call_command("update_all_players", "--force")
+
+        self.player_9090YYGQ.refresh_from_db()
+        self.player_2RQRYV0L.refresh_from_db()
+        self.assertEqual(self.player_9090YYGQ.trophy_count, 30616)
+        # Not marked as updated, fetched again by the next run
+        self.assertEqual(self.player_2RQRYV0L.trophy_count, 1000)
+        self.assertIsNone(self.player_2RQRYV0L.last_updated)
+        self.assertTrue(PlayersUpdate.objects.get().completed)
+
+    @mock.patch("player_lookup.brawlstars_api.get_retry_delay", return_value=0)
+    @mock.patch("httpx.AsyncClient.get")
+    @mock.patch("player_lookup.utils.get_club_league_status")
+    @freeze_time("2022-10-26", tick=True)
+    def test_unreachable_club_doesnt_stop_the_run(
+        self,
+        mocked_club_league_status,
+        mocked_httpx_get,
+        mocked_retry_delay,
+    ):
+        mocked_club_league_status.return_value = False
+        route = route_api_responses(
+            {
+                "players/%239090YYGQ": self.player_data_9090YYGQ,
+                "players/%232RQRYV0L": self.player_data_2RQRYV0L,
+                "players/%239090YYGQ/battlelog": self.player_battlelog_9090YYGQ,
+                "players/%232RQRYV0L/battlelog": self.player_battlelog_2RQRYV0L,
+            }
+        )
+        club_failures = [
+            httpx.ReadTimeout("Timed out"),
+            # E.g. from a proxy, after all its retries
+            httpx.Response(503, text="<html>Service Unavailable</html>"),
+        ]
+        for club_failure in club_failures:
+
+            def mocked_get(url, *args, **kwargs):
+                if "clubs/" not in url:
+                    return route(url, *args, **kwargs)
+                if isinstance(club_failure, Exception):
+                    raise club_failure
+                return club_failure
+
+            mocked_httpx_get.side_effect = mocked_get
+            call_command("update_all_players", "--force")
+
+            self.player_9090YYGQ.refresh_from_db()
+            self.assertEqual(self.player_9090YYGQ.trophy_count, 30616)
+            self.assertFalse(Club.objects.exists())
+            self.assertTrue(PlayersUpdate.objects.last().completed)
+
+    @mock.patch("httpx.AsyncClient.get")
+    @mock.patch("player_lookup.utils.get_club_league_status")
+    @freeze_time("2022-10-26", tick=True)
+    def test_resume_interrupted_update(
+        self,
+        mocked_club_league_status,
+        mocked_httpx_get,
+    ):
+        mocked_club_league_status.return_value = True
+        mocked_httpx_get.side_effect = route_api_responses(
+            {
+                "players/%239090YYGQ": self.player_data_9090YYGQ,
+                "players/%239090YYGQ/battlelog": self.player_battlelog_9090YYGQ,
+                "clubs/%23P0GVGVRP": self.club_data_P0GVGVRP,
+            }
+        )
+        # The interrupted run stopped after updating #2RQRYV0L, first in order
+        interrupted_run = PlayersUpdate.objects.create(
+            club_league_running=True,
+            last_club_league_day=datetime(2022, 10, 26, tzinfo=timezone.utc),
+            min_last_updated=datetime.now(timezone.utc),
+            last_position=[0, None, "#2RQRYV0L"],
+            batches_done=1,
+            players_updated=1,
+        )
+        call_command("update_all_players", "--resume")
+
+        self.player_9090YYGQ.refresh_from_db()
+        self.player_2RQRYV0L.refresh_from_db()
+        self.assertEqual(self.player_9090YYGQ.trophy_count, 30616)
+        self.assertEqual(self.player_2RQRYV0L.trophy_count, 1000)
+
+        interrupted_run.refresh_from_db()
+        self.assertTrue(interrupted_run.completed)
+        self.assertEqual(interrupted_run.batches_done, 2)
+        self.assertEqual(interrupted_run.players_updated, 2)
+        self.assertEqual(interrupted_run.last_position, [0, None, "#9090YYGQ"])
+        # No new run was started
+        self.assertEqual(PlayersUpdate.objects.count(), 1)
+
+    @mock.patch("httpx.AsyncClient.get")
+    @mock.patch("player_lookup.utils.get_club_league_status")
+    @freeze_time("2022-11-01", tick=True)
+    def test_resume_after_club_league_ended(
+        self,
+        mocked_club_league_status,
+        mocked_httpx_get,
+    ):
+        # The run was interrupted on Monday, club league ended on Tuesday
+        mocked_club_league_status.return_value = False
+        mocked_httpx_get.side_effect = route_api_responses(
+            {
+                "players/%239090YYGQ": self.player_data_9090YYGQ,
+                "players/%232RQRYV0L": self.player_data_2RQRYV0L,
+                "players/%239090YYGQ/battlelog": self.player_battlelog_9090YYGQ,
+                "players/%232RQRYV0L/battlelog": self.player_battlelog_2RQRYV0L,
+                "clubs/%23P0GVGVRP": self.club_data_P0GVGVRP,
+            }
+        )
+        interrupted_run = PlayersUpdate.objects.create(
+            club_league_running=True,
+            last_club_league_day=datetime(2022, 10, 30, tzinfo=timezone.utc),
+            min_last_updated=datetime.now(timezone.utc),
+            last_position=[0, None, "#2RQRYV0L"],
+            batches_done=1,
+            players_updated=1,
+        )
+        call_command("update_all_players", "--resume")
+
+        interrupted_run.refresh_from_db()
+        self.assertFalse(interrupted_run.completed)
+        new_run = PlayersUpdate.objects.last()
+        self.assertNotEqual(new_run.pk, interrupted_run.pk)
+        self.assertTrue(new_run.completed)
+        self.assertFalse(new_run.club_league_running)
+        self.assertIsNone(new_run.last_club_league_day)
+        self.assertEqual(new_run.players_updated, 2)
+
+    @mock.patch("httpx.AsyncClient.get")
+    @mock.patch("player_lookup.utils.get_club_league_status")
+    @freeze_time("2022-10-26", tick=True)
+    def test_resume_doesnt_pick_abandoned_run(
+        self,
+        mocked_club_league_status,
+        mocked_httpx_get,
+    ):
+        mocked_club_league_status.return_value = False
+        mocked_httpx_get.side_effect = route_api_responses(
+            {
+                "players/%239090YYGQ": self.player_data_9090YYGQ,
+                "players/%232RQRYV0L": self.player_data_2RQRYV0L,
+                "players/%239090YYGQ/battlelog": self.player_battlelog_9090YYGQ,
+                "players/%232RQRYV0L/battlelog": self.player_battlelog_2RQRYV0L,
+                "clubs/%23P0GVGVRP": self.club_data_P0GVGVRP,
+            }
+        )
+        # An old run was abandoned, a newer one completed
+        abandoned_run = PlayersUpdate.objects.create(
+            min_last_updated=datetime.now(timezone.utc),
+            last_position=[0, None, "#2RQRYV0L"],
+            batches_done=1,
+            players_updated=1,
+        )
+        PlayersUpdate.objects.create(
+            min_last_updated=datetime.now(timezone.utc), completed=True
+        )
+        call_command("update_all_players", "--resume")
+
+        abandoned_run.refresh_from_db()
+        self.assertFalse(abandoned_run.completed)
+        self.assertEqual(abandoned_run.players_updated, 1)
+        self.assertEqual(PlayersUpdate.objects.count(), 3)
+        self.assertEqual(PlayersUpdate.objects.last().players_updated, 2)
+
+    @mock.patch("httpx.AsyncClient.get")
+    @mock.patch("player_lookup.utils.get_club_league_status")
+    @freeze_time("2022-10-26", tick=True)
+    def test_sharded_update(
+        self,
+        mocked_club_league_status,
+        mocked_httpx_get,
+    ):
+        mocked_club_league_status.return_value = False
+        mocked_httpx_get.side_effect = route_api_responses(
+            {
+                "players/%239090YYGQ": self.player_data_9090YYGQ,
+                "players/%232RQRYV0L": self.player_data_2RQRYV0L,
+                "players/%239090YYGQ/battlelog": self.player_battlelog_9090YYGQ,
+                "players/%232RQRYV0L/battlelog": self.player_battlelog_2RQRYV0L,
+                "clubs/%23P0GVGVRP": self.club_data_P0GVGVRP,
+            }
+        )
+        # #9090YYGQ is in the first shard, #2RQRYV0L in the second one
+        call_command("update_all_players", "--shard", "0/2")
+        self.player_9090YYGQ.refresh_from_db()
+        self.player_2RQRYV0L.refresh_from_db()
+        self.assertEqual(self.player_9090YYGQ.trophy_count, 30616)
+        self.assertEqual(self.player_2RQRYV0L.trophy_count, 1000)
+
+        call_command("update_all_players", "--shard", "1/2")
+        self.player_2RQRYV0L.refresh_from_db()
+        self.assertEqual(self.player_2RQRYV0L.trophy_count, 30425)
+        self.assertEqual(
+            list(PlayersUpdate.objects.values_list("shard_index", "players_updated")),
+            [(0, 1), (1, 1)],
+        )
+
+    def test_tickets_are_reset_by_the_first_shard(self):
+        Player.objects.update(number_of_available_tickets=4)
+        # The last run of the first shard ran during club league, the other
+        # shard's last run didn't
+        PlayersUpdate.objects.create(
+            club_league_running=True, shard_index=0, shard_count=2, completed=True
+        )
+        PlayersUpdate.objects.create(
+            club_league_running=False, shard_index=1, shard_count=2, completed=True
+        )
+        command = update_all_players.Command()
+        command.club_league_running = False
+        command.last_club_league_day = None
+        command.today_number_of_remaining_tickets = 0
+        now = datetime.now(timezone.utc)
+
+        command.shard_index, command.shard_count = 1, 2
+        command.start_new_run(now)
+        self.assertEqual(
+            set(Player.objects.values_list("number_of_available_tickets", flat=True)),
+            {4},
+        )
+
+        command.shard_index = 0
+        command.start_new_run(now)
+        self.assertEqual(
+            set(Player.objects.values_list("number_of_available_tickets", flat=True)),
+            {0},
+        )
+
+    @mock.patch("httpx.AsyncClient.get")
+    def test_update_already_running(self, mocked_httpx_get):
+        running_lock = ShardedRunLock("update_all_players", 0, 1)
+        self.assertTrue(running_lock.acquire())
+        call_command("update_all_players", "--force")
+        # Sharding the players differently would update the same players
+        call_command("update_all_players", "--force", "--shard", "0/2")
+        call_command("update_all_players", "--force", "--shard", "1/2")
+        mocked_httpx_get.assert_not_called()
+        self.assertFalse(PlayersUpdate.objects.exists())
+
+        running_lock.release()
+        self.assertTrue(ShardedRunLock("update_all_players", 0, 2).acquire())
+
+
+class UpdatePlayerInfosTests(TestCase):
+    def setUp(self):
+        self.old_club = Club.objects.create(club_tag="#OLD", club_name="Old")
+        self.known_club = Club.objects.create(club_tag="#KNOWN", club_name="Known")
+        for index in range(6):
+            Player.objects.create(
+                player_tag=f"#PLAYER{index}",
+                player_name="Player",
+                club=self.old_club,
+            )
+
+    def test_players_and_clubs_are_loaded_at_once(self):
+        tag_clubtag = {
+            "#PLAYER0": "#OLD",
+            "#PLAYER1": None,
+            "#PLAYER2": "#KNOWN",
+            "#PLAYER3": "#KNOWN",
+            "#PLAYER4": "#NEW",
+            "#PLAYER5": "#UNAVAILABLE",
+            # Deleted since the batch was selected
+            "#DELETED": "#KNOWN",
+        }
+        tag_infos = {tag: None for tag in tag_clubtag}
+        tag_infos["#PLAYER0"] = {
+            "player_name": "New name",
+            "level": 100,
+            "trophy_count": 20000,
+            "total_3v3_wins": 1,
+            "solo_wins": 2,
+            "duo_wins": 3,
+        }
+        command = update_all_players.Command()
+        with mock.patch.object(
+            command,
+            "create_club_batch",
+            # The API couldn't give the information of #UNAVAILABLE
+            return_value=[Club(club_tag="#NEW", club_name="New")],
+        ) as mocked_create_club_batch:
+            # Players, clubs and the insert of the new clubs
+            with self.assertNumQueries(3):
+                players = command.update_player_infos(tag_clubtag, tag_infos)
+
+        mocked_create_club_batch.assert_called_once_with(["#NEW", "#UNAVAILABLE"])
+        self.assertEqual(
+            {player.player_tag: player.club_id for player in players},
+            {
+                "#PLAYER0": "#OLD",
+                "#PLAYER1": None,
+                "#PLAYER2": "#KNOWN",
+                "#PLAYER3": "#KNOWN",
+                "#PLAYER4": "#NEW",
+                "#PLAYER5": "#OLD",
+            },
+        )
+        self.assertEqual(players[0].player_name, "New name")
+        self.assertTrue(Club.objects.filter(club_tag="#NEW").exists())
+
 
 class TestGetNewPlayers(TestCase):
     def setUp(self):
@@ -101,6 +444,61 @@ class TestGetNewPlayers(TestCase):
             ["#2RQRYV0L", "#9090YYGQ"],
         )
 
+    @mock.patch("httpx.AsyncClient.get")
+    @mock.patch("player_lookup.management.commands.get_new_players.CLUB_BATCH_SIZE", 2)
+    def test_get_new_players_of_several_batches(self, mocked_httpx_get):
+        other_club = Club.objects.create(club_tag="#OTHER", club_name="Other Club")
+        Club.objects.create(club_tag="#UNAVAILABLE", club_name="Unavailable Club")
+        Player.objects.create(
+            player_tag="#9090YYGQ", player_name="Old name", club=other_club
+        )
+        Player.objects.create(
+            player_tag="#LEFT", player_name="Left", club=self.club_P0GVGVRP
+        )
+        Player.objects.create(
+            player_tag="#STAYED", player_name="Stayed", club=other_club
+        )
+        mocked_httpx_get.side_effect = route_api_responses(
+            {
+                "clubs/%23P0GVGVRP/members": self.club_members_P0GVGVRP,
+                "clubs/%23OTHER/members": {
+                    "items": [
+                        {"tag": "#OTHERPLAYER", "name": "Other", "trophies": 100},
+                        {"tag": "#STAYED", "name": "Stayed", "trophies": 200},
+                    ]
+                },
+                # A failed club doesn't prevent the others from being saved
+                "clubs/%23UNAVAILABLE/members": {"reason": "notFound"},
+            }
+        )
+        call_command("get_new_players")
+
+        self.assertEqual(mocked_httpx_get.call_count, 3)
+        self.assertEqual(
+            {
+                player.player_tag: (player.player_name, player.trophy_count)
+                for player in Player.objects.all()
+            },
+            {
+                "#2RQRYV0L": ("Shriukan", 30425),
+                "#9090YYGQ": ("Poulet", 30616),
+                "#LEFT": ("Left", 0),
+                "#OTHERPLAYER": ("Other", 100),
+                "#STAYED": ("Stayed", 200),
+            },
+        )
+        # Club membership changes are saved
+        self.assertEqual(
+            dict(Player.objects.values_list("player_tag", "club")),
+            {
+                "#2RQRYV0L": "#P0GVGVRP",
+                "#9090YYGQ": "#P0GVGVRP",
+                "#LEFT": None,
+                "#OTHERPLAYER": "#OTHER",
+                "#STAYED": "#OTHER",
+            },
+        )
+
 
 class TestMakePlayersHistory(TestCase):
     def setUp(self):
@@ -127,3 +525,82 @@ class TestMakePlayersHistory(TestCase):
             ),
             ["#2RQRYV0L", "#9090YYGQ"],
         )
+
+    def test_snapshot_copies_the_players(self):
+        for index in range(5):
+            Player.objects.create(
+                player_tag=f"#PLAYER{index}",
+                player_name="Player",
+                trophy_count=index,
+                total_club_war_trophy_count=10 * index,
+                brawlclub_rating=index / 2,
+                club_league_playrate=index / 3,
+                club_league_winrate=index / 4,
+                club_league_teamplay_rate=index / 5,
+            )
+        for batch_size in (2, 0):
+            PlayerHistory.objects.all().delete()
+            with freeze_time("2022-11-02 12:00:00"):
+                call_command("make_players_history", batch_size=batch_size)
+
+            history = PlayerHistory.objects.select_related("player")
+            self.assertEqual(len(history), 7)
+            for player_history in history:
+                self.assertEqual(
+                    player_history.snapshot_date,
+                    datetime(2022, 11, 2, 12, tzinfo=timezone.utc),
+                )
+                for field in (
+                    "trophy_count",
+                    "total_club_war_trophy_count",
+                    "brawlclub_rating",
+                    "club_league_playrate",
+                    "club_league_winrate",
+                    "club_league_teamplay_rate",
+                ):
+                    self.assertEqual(
+                        getattr(player_history, field),
+                        getattr(player_history.player, field),
+                    )
+
+
+class TestRebuildClubLeagueCounters(TestCase):
+    def setUp(self):
+        brawler = Brawler.objects.create(name="SHELLY")
+        match = Match.objects.create(
+            match_id="match",
+            mode="gemGrab",
+            map_played=BrawlMap.objects.create(name="Hard Rock Mine"),
+            battle_type="Power Match",
+            date=datetime(2022, 10, 27, tzinfo=timezone.utc),
+        )
+        for index in range(3):
+            player = Player.objects.create(
+                player_tag=f"#PLAYER{index}", player_name="Player"
+            )
+            MatchIssue.objects.create(
+                match=match, player=player, brawler=brawler, outcome="WIN"
+            )
+        Player.objects.update(default_date=datetime(2022, 10, 26, tzinfo=timezone.utc))
+
+    def test_rebuild_club_league_counters(self):
+        # Out of sync counters, e.g. match issues saved outside MatchRegistry
+        ClubLeagueCounters.objects.create(
+            player_id="#PLAYER0",
+            since=datetime(2022, 10, 26, tzinfo=timezone.utc),
+            all_matches_count=5,
+        )
+        call_command("rebuild_club_league_counters", batch_size=2)
+
+        self.assertEqual(ClubLeagueCounters.objects.count(), 3)
+        for counters in ClubLeagueCounters.objects.all():
+            self.assertEqual(
+                counters.get_counts(),
+                {
+                    "all_matches_count": 1,
+                    "all_wins": 1,
+                    "all_losses": 0,
+                    "played_with_clubmate": 0,
+                    "power_match": 1,
+                },
+            )
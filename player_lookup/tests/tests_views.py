@@ -9,6 +9,7 @@ from django.db.models import Avg, Count
 from django.test import TestCase
 from django.urls import reverse
 from player_lookup.models import Club, Player, PlayerHistory
+from player_lookup.tests.helpers import route_api_responses
 
 
 class ClubFinderTests(TestCase):
@@ -332,21 +333,18 @@ class SearchUnknownEntityTests(TestCase):
             # to update the club's informations
             mock.MagicMock(json=mock.MagicMock(return_value=self.club_data_P0GVGVRP)),
         ]
-        mock_httpx_get.side_effect = [
-            # First call is for the player's profile
-            httpx.Response(200, json=self.player_data_2RQRYV0L),
-            # Second call is for the player's battlelog
-            httpx.Response(200, json=self.player_battlelog_2RQRYV0L),
-            # Third call is for the club's members
-            httpx.Response(200, json=self.club_members_P0GVGVRP),
-            # Fourth & fifth calls are for the player's profile,
-            # in order in the members list
-            httpx.Response(200, json=self.player_data_2RQRYV0L),
-            httpx.Response(200, json=self.player_data_9090YYGQ),
-            # Sixth and seventh calls are for the players' battlelog
-            httpx.Response(200, json=self.player_battlelog_2RQRYV0L),
-            httpx.Response(200, json=self.player_battlelog_9090YYGQ),
-        ]
+        mock_httpx_get.side_effect = route_api_responses(
+            {
+                # The player's profile and battlelog, then the same for each
+                # member of their club
+                "players/%232RQRYV0L": self.player_data_2RQRYV0L,
+                "players/%232RQRYV0L/battlelog": self.player_battlelog_2RQRYV0L,
+                "players/%239090YYGQ": self.player_data_9090YYGQ,
+                "players/%239090YYGQ/battlelog": self.player_battlelog_9090YYGQ,
+                # The club's members
+                "clubs/%23P0GVGVRP/members": self.club_members_P0GVGVRP,
+            }
+        )
 
         url = reverse("player_lookup:search_unknown", args=["2RQRYV0L"])
         response = self.client.get(url)
@@ -372,17 +370,17 @@ class SearchUnknownEntityTests(TestCase):
             # club's informations
             mock.MagicMock(json=mock.MagicMock(return_value=self.club_data_P0GVGVRP)),
         ]
-        mock_httpx_get.side_effect = [
-            # 1st call is for the club's members
-            httpx.Response(200, json=self.club_members_P0GVGVRP),
-            # 2nd & 3r calls are for the player's profile,
-            # in order in the members list
-            httpx.Response(200, json=self.player_data_2RQRYV0L),
-            httpx.Response(200, json=self.player_data_9090YYGQ),
-            # 4th and 5th calls are for the players' battlelog
-            httpx.Response(200, json=self.player_battlelog_2RQRYV0L),
-            httpx.Response(200, json=self.player_battlelog_9090YYGQ),
-        ]
+        mock_httpx_get.side_effect = route_api_responses(
+            {
+                # The club's members
+                "clubs/%23P0GVGVRP/members": self.club_members_P0GVGVRP,
+                # Each member's profile and battlelog
+                "players/%232RQRYV0L": self.player_data_2RQRYV0L,
+                "players/%232RQRYV0L/battlelog": self.player_battlelog_2RQRYV0L,
+                "players/%239090YYGQ": self.player_data_9090YYGQ,
+                "players/%239090YYGQ/battlelog": self.player_battlelog_9090YYGQ,
+            }
+        )
 
         url = reverse("player_lookup:search_unknown", args=["#P0GVGVRP"])
         response = self.client.get(url)
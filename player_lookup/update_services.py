@@ -1,69 +1,70 @@
 import asyncio
 import logging
 from datetime import datetime
-from typing import List, Tuple, TYPE_CHECKING
+from typing import Dict, Iterable, List, Set, Tuple, Type, TYPE_CHECKING, Union
 
-import dateutil.parser
-import httpx
+import requests
 from asgiref.sync import async_to_sync, sync_to_async
+from django.db import transaction
 
 from . import models
-from .brawlstars_api import BrawlAPi
+from .brawlstars_api import BrawlAPi, RetryBudget
+from .match_types import NORMAL_MATCH, POWER_MATCH, UNKNOWN_MATCH, get_match_type
+from .utils import chunks, parse_battle_time
 
 brawl_api = BrawlAPi()
 
 logger = logging.getLogger("django")
 
 if TYPE_CHECKING:  # pragma: no cover
-    from django.db.models.query import QuerySet
+    from django.db.models import Model
 
 
 @async_to_sync
 async def get_club_members_data(club_tag) -> dict:
     """Get the profile page and battlelog of every member of a given club"""
-    member_list = await brawl_api.get_club_members_tag_list(club_tag)
-    # We prepare the api calls in a list so we're able to await them all
-    api_calls = []
-    async with httpx.AsyncClient(timeout=3600) as client:
+    async with brawl_api.session():
+        member_list = await brawl_api.get_club_members_tag_list(club_tag)
+        # Profiles and battlelogs of the whole club share the same retry budget
+        retry_budget = RetryBudget.for_batch(len(member_list) * 2)
+        # We prepare the api calls in a list so we're able to await them all
+        api_calls = []
         for member in member_list:
-            response = get_player_data(member, client)
+            response = get_player_profile_and_battlelog(member, retry_budget)
             api_calls.append(response)
 
         # We await all the api calls
         responses = await asyncio.gather(*api_calls)
-    # The respons is a list of all players profile from the given clan
-    results = {"Player data": responses}
-    # tag_profile = {player["tag"]: player for player in results["Player data"]}
 
     tag_profile = {}
-    for player in results["Player data"]:
-        tag = player.get("tag", None)
+    tag_battlelog = {}
+    for profile, battlelog in responses:
+        tag = profile.get("tag", None)
         if not tag:
             continue
-        tag_profile[tag] = player
-
-    # We now get the battlelog of each player usig the tags we retrieved
-    api_calls = []
-    async with httpx.AsyncClient(timeout=3600) as client:
-        for tag, _ in tag_profile.items():
-            response = get_player_battlelog(tag, client)
-            api_calls.append(response)
-
-        battlelogs = await asyncio.gather(*api_calls)
-
-    # Now we match the battlelogs with the player tags
-    tag_battlelog = {}
-    for tag, battlelog in zip(tag_profile.keys(), battlelogs):
+        tag_profile[tag] = profile
         tag_battlelog[tag] = battlelog
 
     return tag_profile, tag_battlelog
 
 
-async def get_player_data(player_tag: str, client: httpx.AsyncClient) -> dict:
+async def get_player_data(
+    player_tag: str, retry_budget: Union[RetryBudget, None] = None
+) -> dict:
     """Return player's profile data given a player tag"""
     url = brawl_api.get_player_stats_url(player_tag)
-    response = await client.get(url, headers=brawl_api.headers)
-    return response.json()
+    return await brawl_api.get_json(url, retry_budget)
+
+
+async def get_player_profile_and_battlelog(
+    player_tag: str, retry_budget: Union[RetryBudget, None] = None
+) -> Tuple[dict, dict]:
+    """Return player's profile data and battlelog, both requested at once"""
+    profile, battlelog = await asyncio.gather(
+        get_player_data(player_tag, retry_budget),
+        get_player_battlelog(player_tag, retry_budget),
+    )
+    return profile, battlelog
 
 
 def update_club_members(club_tag: str) -> None:
@@ -89,16 +90,105 @@ def update_club_members(club_tag: str) -> None:
         players_to_update, ["trophy_count", "club", "player_name"], 999
     )
 
+    all_brawlers = NameIndex(models.Brawler)
+    all_maps = NameIndex(models.BrawlMap)
+    brawler_names, map_names = get_battlelogs_names(tag_battlelogs.values())
+    all_brawlers.add_missing(brawler_names)
+    all_maps.add_missing(map_names)
+    match_registry = MatchRegistry()
     for tag, battlelog in tag_battlelogs.items():
-        match_issues = create_matches_from_battlelog(tag, battlelog)
+        create_matches_from_battlelog(
+            tag, battlelog, all_brawlers, all_maps, match_registry
+        )
+    match_registry.save()
+
+
+def save_club_members(club_members: Dict[str, list]) -> Tuple[int, int, int]:
+    """Save the members of a batch of clubs, as listed by the API.
+
+    Unknown players are created with their name, trophies and club, so their
+    profile doesn't need to be fetched first. Known players get these fields
+    updated, and players who left one of the clubs are removed from it. The
+    clubs must already be saved.
+
+    Keyword arguments:
+    - club_members -- the members of each club, see
+    BrawlAPi.get_club_batch_members
+
+    Returns:
+    - the number of players created
+    - the number of players updated
+    - the number of players who left one of the clubs
+    """
+    member_club_tag = {}
+    members = {}
+    for club_tag, club_member_list in club_members.items():
+        for member in club_member_list:
+            member_club_tag[member["tag"]] = club_tag
+            members[member["tag"]] = member
+
+    players_to_update = []
+    for player_tags in chunks(list(members)):
+        players_to_update += models.Player.objects.filter(
+            player_tag__in=player_tags
+        ).only("player_tag", "player_name", "trophy_count", "club")
+    for player in players_to_update:
+        member = members[player.player_tag]
+        player.player_name = member["name"]
+        player.trophy_count = member["trophies"]
+        player.club_id = member_club_tag[player.player_tag]
+
+    known_player_tags = {player.player_tag for player in players_to_update}
+    players_to_create = [
+        models.Player(
+            player_tag=player_tag,
+            player_name=member["name"],
+            trophy_count=member["trophies"],
+            club_id=member_club_tag[player_tag],
+        )
+        for player_tag, member in members.items()
+        if player_tag not in known_player_tags
+    ]
+
+    # Players still in one of the clubs but missing from its member list
+    players_who_left = []
+    for club_tags in chunks(list(club_members)):
+        players_who_left += [
+            player_tag
+            for player_tag in models.Player.objects.filter(
+                club_id__in=club_tags
+            ).values_list("player_tag", flat=True)
+            if player_tag not in member_club_tag
+        ]
+
+    with transaction.atomic():
+        # Another process may have created some of them meanwhile
+        models.Player.objects.bulk_create(players_to_create, ignore_conflicts=True)
+        models.Player.objects.bulk_update(
+            players_to_update, ["player_name", "trophy_count", "club"], 999
+        )
+        for player_tags in chunks(players_who_left):
+            models.Player.objects.filter(player_tag__in=player_tags).update(club=None)
+
+    return len(players_to_create), len(players_to_update), len(players_who_left)
 
-    if match_issues:
-        models.MatchIssue.objects.bulk_create(match_issues)
 
+def create_or_update_club(club_tag: Union[str, None]) -> Union[models.Club, None]:
+    """Create  or udpate a club
 
-def create_or_update_club(club_tag: str) -> models.Club:
-    """Create  or udpate a club"""
-    club_information = brawl_api.get_club_information(club_tag)
+    When the API can't give the club's information, the club is returned as
+    it was saved, None if it never was.
+    """
+    if club_tag is None:
+        return None
+    try:
+        club_information = brawl_api.get_club_information(club_tag)
+    except (requests.RequestException, ValueError) as error:
+        # ValueError: the response isn't JSON
+        club_information = {"reason": type(error).__name__}
+    if "tag" not in club_information:
+        logger.info(f"{club_tag}: Club unavailable ({club_information.get('reason')})")
+        return models.Club.objects.filter(club_tag=club_tag).first()
     defaults = {
         "club_name": club_information["name"],
         "club_description": club_information.get("description", ""),
@@ -141,34 +231,203 @@ def create_player_instance(player: dict, club: models.Club) -> models.Player:
     return player_instance
 
 
-async def get_player_battlelog(player_tag: str, client: httpx.AsyncClient) -> dict:
+async def get_player_battlelog(
+    player_tag: str, retry_budget: Union[RetryBudget, None] = None
+) -> dict:
     """Return player's battlelog given a player tag."""
     url = brawl_api.get_player_battlelog_url(player_tag)
-    response = await client.get(url, headers=brawl_api.headers)
-    return response.json()
+    return await brawl_api.get_json(url, retry_budget)
+
+
+def is_club_league_battle(battle: dict) -> bool:
+    """Tell whether a battle of a battlelog is a club league match."""
+    # We are only interested in Team ranked matches
+    return battle.get("battle", {}).get("type", None) == "teamRanked" and bool(
+        battle.get("battle", {}).get("trophyChange", None)
+    )
+
+
+def get_match_id(battle: dict) -> str:
+    """Return the id of the match a club league battle belongs to.
+
+    The match id is the star player's tag without # followed by the battle's
+    timestamp, so it's the same in the battlelog of every participant.
+    """
+    star_players_tag = battle["battle"].get("starPlayer", {}).get("tag", "")[1:]
+    _, timestamp = parse_battle_time(battle["battleTime"])
+    return f"{star_players_tag}{timestamp}"
+
+
+def get_battlelogs_names(battlelogs: Iterable[dict]) -> Tuple[Set[str], Set[str]]:
+    """Return the names of the brawlers and maps of club league battles.
+
+    Keyword arguments:
+    - battlelogs -- the battlelogs of a batch of players
+
+    Returns:
+    - a set of brawler names
+    - a set of map names
+    """
+    brawler_names = set()
+    map_names = set()
+    for battlelog in battlelogs:
+        for battle in battlelog.get("items", []):
+            if not is_club_league_battle(battle):
+                continue
+            map_names.add(battle["event"].get("map", None))
+            for team in battle["battle"]["teams"]:
+                for player in team:
+                    brawler_names.add(player["brawler"]["name"])
+    return brawler_names, map_names
+
+
+class NameIndex:
+    """Instances of a small table (Brawler, BrawlMap) by name, kept in memory.
+
+    Loaded once per run, so looking up the brawler or map of a battle is a
+    dict lookup instead of a query. Names missing from the index are looked
+    up again in the database before being created, new brawlers and maps can
+    be added by another process while a run is going.
+    """
+
+    def __init__(self, model: "Type[Model]") -> None:
+        self.model = model
+        self.instances: Dict[str, "Model"] = {}
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Reload every instance from the database."""
+        self.instances = {
+            instance.name: instance for instance in self.model.objects.all()
+        }
+
+    def add_missing(self, names: Iterable[str]) -> None:
+        """Create the instances missing from the index, with a single insert."""
+        missing_names = {name for name in names if name} - self.instances.keys()
+        if not missing_names:
+            return
+        # Some might have been created since the index was loaded
+        self.refresh()
+        missing_names -= self.instances.keys()
+        if missing_names:
+            logger.info(f"Creating {self.model.__name__}: {sorted(missing_names)}")
+            self.model.objects.bulk_create(
+                [self.model(name=name) for name in missing_names]
+            )
+            # Not every database returns the primary keys of bulk inserts
+            self.refresh()
+
+    def get_or_create(self, name: str) -> "Model":
+        """Return the instance with the given name, create it if needed."""
+        if name not in self.instances:
+            self.add_missing([name])
+        return self.instances[name]
+
+
+class MatchRegistry:
+    """Matches and match issues of a batch of battlelogs, keyed by match id.
+
+    A club league match shows up in the battlelog of each of its tracked
+    participants. The registry builds it once, the following battlelogs of
+    the batch attach their match issue to the same instance, and save writes
+    the matches and match issues of the whole batch at once.
+
+    Matches that are already saved are skipped by the database's unique
+    constraint when inserting, so we don't look them up beforehand. The match
+    issues of the batch are looked up with a single query when saving, to
+    count only the new ones in the club league counters, and the unique
+    constraint keeps concurrent ingestions of the same battles safe.
+    """
+
+    def __init__(self) -> None:
+        # Matches by match id
+        self.matches: Dict[str, models.Match] = {}
+        # (match id, player tag) of every match issue
+        self.match_issues: Set[Tuple[str, str]] = set()
+        # Added since the last save
+        self.new_matches: List[models.Match] = []
+        self.new_match_issues: List[models.MatchIssue] = []
+
+    def get_match(self, match_id: str) -> Union[models.Match, None]:
+        return self.matches.get(match_id)
+
+    def add_match(self, match: models.Match) -> None:
+        self.matches[match.match_id] = match
+        self.new_matches.append(match)
+
+    def has_match_issue(self, match_id: str, player_tag: str) -> bool:
+        return (match_id, player_tag) in self.match_issues
+
+    def add_match_issue(self, match_issue: models.MatchIssue) -> None:
+        self.match_issues.add((match_issue.match_id, match_issue.player_id))
+        self.new_match_issues.append(match_issue)
+
+    def save(self) -> int:
+        """Save the matches and match issues added since the last save.
+
+        Those already in the database are left untouched. The new match issues
+        are counted in their players' club league counters.
+
+        Returns:
+        - the number of new match issues
+        """
+        # The match issues point to the new matches, which must be saved first
+        with transaction.atomic():
+            models.Match.objects.bulk_create(self.new_matches, ignore_conflicts=True)
+            # Another process saving the same match issues waits until we
+            # commit, then finds them saved and doesn't count them again
+            counters = models.lock_club_league_counters(
+                match_issue.player_id for match_issue in self.new_match_issues
+            )
+            saved_match_issues = set(
+                models.MatchIssue.objects.filter(
+                    match_id__in={
+                        match_issue.match_id for match_issue in self.new_match_issues
+                    }
+                ).values_list("match_id", "player_id")
+            )
+            unsaved_match_issues = [
+                match_issue
+                for match_issue in self.new_match_issues
+                if (match_issue.match_id, match_issue.player_id)
+                not in saved_match_issues
+            ]
+            models.MatchIssue.objects.bulk_create(
+                unsaved_match_issues, ignore_conflicts=True
+            )
+            models.add_to_club_league_counters(unsaved_match_issues, counters)
+        self.new_matches = []
+        self.new_match_issues = []
+        return len(unsaved_match_issues)
 
 
 def create_matches_from_battlelog(
     player_tag: str,
     battlelog: dict,
-    all_brawlers: "QuerySet[models.Brawler]" = models.Brawler.objects.all(),
-    all_maps: "QuerySet[models.BrawlMap]" = models.BrawlMap.objects.all(),
+    all_brawlers: Union[NameIndex, None] = None,
+    all_maps: Union[NameIndex, None] = None,
+    match_registry: Union[MatchRegistry, None] = None,
 ) -> List[models.MatchIssue]:
     """
     Create matches from a given battlelog.
 
     Because this function is looping through the battlelog and to avoid
     hitting the database on each loop (24 times per player), we pass the
-    brawlers and maps as arguments.
+    brawlers and maps indexed by name as arguments, and collect the matches
+    of a whole batch in a MatchRegistry.
 
     Keyword arguments:
     - player_tag -- the player's tag
     - battlelog -- the battlelog of the player, including its 24 last matches
-    - all_brawlers -- a queryset of all brawlers
-    - all_maps -- a queryset of all maps
+    - all_brawlers -- index of all brawlers, loaded when not given
+    - all_maps -- index of all maps, loaded when not given
+    - match_registry -- the matches of the batch the battlelog belongs to.
+    The matches and match issues are added to it, call its save method once
+    the whole batch is processed. When not given, the battlelog's matches are
+    saved right away.
 
     Returns:
-    - a list of match issues, ready to be bulk created
+    - the list of the player's match issues
     """
 
     def get_battle_data(
@@ -203,10 +462,7 @@ def create_matches_from_battlelog(
         trophies_won = None
         star_players_tag = None
         played_brawler = None
-        # We are only interested in Team ranked matches
-        if battle.get("battle", {}).get("type", None) == "teamRanked" and battle.get(
-            "battle", {}
-        ).get("trophyChange", None):
+        if is_club_league_battle(battle):
             # Now we examinate each of the two teams to get the winning one
             for team_number, team in enumerate(battle["battle"]["teams"]):
                 for player in team:
@@ -226,7 +482,7 @@ def create_matches_from_battlelog(
             ]
             map_played = battle["event"].get("map", None)
             mode = battle["event"].get("mode", None)
-            battle_date = dateutil.parser.parse(battle["battleTime"])
+            battle_date, _ = parse_battle_time(battle["battleTime"])
             match_outcome = battle["battle"].get("result", None)
             # In the model, we store the outcome as WIN, LOSS or DRAW
             if match_outcome == "victory":
@@ -262,65 +518,23 @@ def create_matches_from_battlelog(
             played_brawler,
         )
 
-    def get_match_type(match_outcome: str) -> Tuple[bool, bool]:
-        """Return the match type.
-
-        Keyword arguments:
-        - match_outcome -- the outcome of the match (Victory, Defeat, Draw)
-
-        Returns:
-        A tuple containing two booleans to indicate if the player played a
-        power match or not and if they played with a clubmate or not.
-        """
-        played_with_team = False
-        is_power_match = False
-        if match_outcome == "WIN":
-            if trophies_won == 9:
-                played_with_team = True
-                is_power_match = True
-            elif trophies_won == 7:
-                is_power_match = True
-                played_with_team = False
-            elif trophies_won == 4:
-                played_with_team = True
-            elif trophies_won == 3:
-                played_with_team = False
-                is_power_match = False
-        elif match_outcome == "LOSS":
-            if trophies_won == 5:
-                played_with_team = True
-                is_power_match = True
-            elif trophies_won == 3:
-                is_power_match = True
-                played_with_team = False
-            elif trophies_won == 2:
-                played_with_team = True
-                is_power_match = False
-            elif trophies_won == 1:
-                played_with_team = False
-                is_power_match = False
-
-        # Can't draw in Power matches
-        elif match_outcome == "DRAW":
-            if trophies_won == 3:
-                played_with_team = True
-                is_power_match = False
-            elif trophies_won == 2:
-                played_with_team = False
-                is_power_match = False
-
-        return (is_power_match, played_with_team)
-
-    match_batch = []
-    incomplete_match_issue_list = []
-    match_issues_with_pre_existing_match_batch = []
     match_issues_batch = []
-    player = None
     if battlelog.get("reason", None) == "notFound":
         # Happens sometimes that the player's battlelog can't be found
         # It's not specific to this app
         logger.info(player_tag + ": Battlelog not found")
         return []
+    if "items" not in battlelog:
+        # Still throttled or unavailable after all retries
+        logger.info(f"{player_tag}: Battlelog unavailable ({battlelog.get('reason')})")
+        return []
+    if all_brawlers is None:
+        all_brawlers = NameIndex(models.Brawler)
+    if all_maps is None:
+        all_maps = NameIndex(models.BrawlMap)
+    save_registry = match_registry is None
+    if save_registry:
+        match_registry = MatchRegistry()
     for battle in battlelog["items"]:
         (
             player_list,
@@ -334,28 +548,27 @@ def create_matches_from_battlelog(
             star_players_tag,
             brawler_used,
         ) = get_battle_data(player_tag, battle)
-        match_already_exists = False
         if player_list:
-            if not player:
-                # We get the player from the database the first time only as the player
-                # tag is the same for all battles
-                player = models.Player.objects.get(player_tag=player_tag)
-            # We don't want to create a match if it already exists
-            match_id = f"{star_players_tag}{battle_date.strftime('%s')}"
-            played_with_team, is_power_match = get_match_type(match_outcome)
-            try:
-                the_match = models.Match.objects.get(match_id=match_id)
-                match_already_exists = True
-            except models.Match.DoesNotExist:
+            match_type = get_match_type(match_outcome, trophies_won)
+            if match_type is None:
+                # Counted in match_types.unknown_match_types, the battle is
+                # saved unclassified for reclassify_matches to classify it once
+                # MATCH_TYPES knows its type
+                logger.info(
+                    f"{player_tag}: Unknown match type"
+                    f" ({match_outcome}, {trophies_won} trophies)"
+                )
+                battle_type, played_with_team = UNKNOWN_MATCH, False
+            else:
+                is_power_match, played_with_team = match_type
+                battle_type = POWER_MATCH if is_power_match else NORMAL_MATCH
+            match_id = get_match_id(battle)
+            the_match = match_registry.get_match(match_id)
+            if the_match is None:
                 # We create a match instance but don't save it yet
-                battle_type = "Power Match" if is_power_match else "Normal Match"
                 # Map pool has a reasonabily small size, so we can store it in memory
                 # and avoid querying the database
-                try:
-                    # Using cached version
-                    the_map = all_maps.get(name=map_played)
-                except models.BrawlMap.DoesNotExist:
-                    the_map = models.BrawlMap.objects.create(name=map_played)
+                the_map = all_maps.get_or_create(map_played)
                 the_match = models.Match(
                     match_id=match_id,
                     mode=mode,
@@ -363,49 +576,30 @@ def create_matches_from_battlelog(
                     battle_type=battle_type,
                     date=battle_date,
                 )
-                match_batch.append(the_match)
-
-            # We now create the associated MatchIssue
-
-            if match_already_exists:
-                # We check if the match already has an issue with the player
-                match_issue_exists = models.MatchIssue.objects.filter(
-                    match=the_match, player=player
-                ).exists()
-                if match_issue_exists:
-                    continue
+                match_registry.add_match(the_match)
+            elif match_registry.has_match_issue(match_id, player_tag):
+                # The match already has an issue with the player
+                continue
 
             # The brawler table has a small number of rows, so we can afford to load
             # it in memory
-            try:
-                # Using cached version
-                brawler = all_brawlers.get(name=brawler_used)
-            except models.Brawler.DoesNotExist:
-                brawler = models.Brawler.objects.create(name=brawler_used)
-            # MatchIssue has a FK to Match, which might not be created yet.
-            # We're going to add it once the Match is created
+            brawler = all_brawlers.get_or_create(brawler_used)
+            # The match's primary key is its match id, so the match issue can
+            # point to it before it's saved, as long as it's saved first
             the_match_issue = models.MatchIssue(
-                player=player,
+                match=the_match,
+                player_id=player_tag,
                 brawler=brawler,
                 outcome=match_outcome,
                 trophies_won=trophies_won,
                 is_star_player=is_star_player,
                 played_with_clubmate=played_with_team,
             )
-            if not match_already_exists:
-                incomplete_match_issue_list.append(the_match_issue)
-            else:
-                the_match_issue.match = the_match
-                match_issues_with_pre_existing_match_batch.append(the_match_issue)
-
-    created_matches = models.Match.objects.bulk_create(match_batch)
-    for match, incomplete_match_issue in zip(
-        created_matches, incomplete_match_issue_list
-    ):
-        incomplete_match_issue.match = match
-        match_issues_batch.append(incomplete_match_issue)
+            match_issues_batch.append(the_match_issue)
+            match_registry.add_match_issue(the_match_issue)
 
-    match_issues_batch.extend(match_issues_with_pre_existing_match_batch)
+    if save_registry:
+        match_registry.save()
 
     return match_issues_batch
 
@@ -419,12 +613,13 @@ async def update_player_profile(player_tag: str) -> None:
     """
     if not player_tag.startswith("#"):
         player_tag = "#" + player_tag
-    async with httpx.AsyncClient(timeout=None) as client:
-        response = get_player_data(player_tag, client)
-        player_profile = await asyncio.gather(response)
-        player_profile = player_profile[0]
-        response = get_player_battlelog(player_tag, client)
-        battlelog = await asyncio.gather(response)
+    async with brawl_api.session():
+        player_profile, battlelog = await get_player_profile_and_battlelog(player_tag)
+    if "tag" not in player_profile:
+        logger.info(
+            f"{player_tag}: Profile unavailable ({player_profile.get('reason')})"
+        )
+        return
 
     player_club_tag = player_profile.get("club", {}).get("tag", None)
 
@@ -441,8 +636,5 @@ async def update_player_profile(player_tag: str) -> None:
     player.club = club
     await sync_to_async(player.save)()
 
-    match_issues = await sync_to_async(create_matches_from_battlelog)(
-        player_tag, battlelog[0]
-    )
-    if match_issues:
-        await sync_to_async(models.MatchIssue.objects.bulk_create)(match_issues)
+    # Saves the new matches and match issues
+    await sync_to_async(create_matches_from_battlelog)(player_tag, battlelog)
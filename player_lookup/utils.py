@@ -1,5 +1,14 @@
-from datetime import datetime, timedelta, timezone
-from typing import Union
+import zlib
+from datetime import date, datetime, time, timedelta, timezone
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterator, List, Sequence, Tuple, Union
+
+from django.db.models import F, Q
+
+from player_lookup.club_league import club_league_calendar, get_ticket_schedule
+
+if TYPE_CHECKING:  # pragma: no cover
+    from django.db.models.query import QuerySet
 
 
 def daterange(start_date: datetime, end_date: datetime):
@@ -8,192 +17,281 @@ def daterange(start_date: datetime, end_date: datetime):
         yield start_date + timedelta(n)
 
 
-def get_number_of_weeks_since_date(since: datetime) -> int:
+@lru_cache(maxsize=4096)
+def parse_battle_time(battle_time: str) -> Tuple[datetime, int]:
+    """Parse the battleTime of a battle, e.g. 20221130T125400.000Z.
+
+    The API always uses this format, in UTC, so we slice it instead of
+    guessing the format like dateutil does, which is much slower. A battle
+    shows up in the battlelog of each of its participants, the result is
+    cached.
+
+    Args:
+        battle_time (str): The battleTime of a battle.
+
+    Returns:
+        datetime: The timezone aware date of the battle, in UTC.
+        int: The number of seconds since epoch.
+    """
+    if len(battle_time) != 20 or battle_time[8] != "T" or battle_time[-1] != "Z":
+        raise ValueError(f"Unexpected battleTime format: {battle_time}")
+    battle_date = datetime(
+        int(battle_time[0:4]),
+        int(battle_time[4:6]),
+        int(battle_time[6:8]),
+        int(battle_time[9:11]),
+        int(battle_time[11:13]),
+        int(battle_time[13:15]),
+        int(battle_time[16:19]) * 1000,
+        tzinfo=timezone.utc,
+    )
+    return battle_date, int(battle_date.timestamp())
+
+
+# First club war since update started on July 6th 2022, an odd week. Club wars
+# only happen in odd weeks.
+DEFAULT_CLUB_LEAGUE_START = datetime(year=2022, month=7, day=6, tzinfo=timezone.utc)
+
+
+def get_number_of_weeks_since_date(
+    since: datetime, today: Union[datetime, None] = None
+) -> int:
     """Get the number whole club league weeks since a date.
 
     Args:
         since (datetime): The date since when the number of club league weeks is
         calculated.
+        today (datetime): The date until when they are counted, now by default.
 
     Returns:
         int: The number of club league weeks since the date.
     """
     if not since:
-        # First club war since update started on July 6th 2022,
-        # an odd week. Club wars only happen in odd weeks.
-        since = datetime(year=2022, month=7, day=6, tzinfo=timezone.utc)
+        since = DEFAULT_CLUB_LEAGUE_START
 
-    today = datetime.now(timezone.utc).replace(
-        hour=0, minute=0, second=0, microsecond=0
-    )
-    club_league_days = 0
-    club_league_weeks = 0
-    for _date in daterange(since, today):
-        if (_date.isocalendar()[1] % 2 != 0 and _date.weekday() not in (0, 1)) or (
-            _date.isocalendar()[1] % 2 == 0 and _date.weekday() == 0
-        ):
-            club_league_days += 1
-        if _date.weekday() == 1:
-            if club_league_days // 5 > 0:
-                club_league_weeks += 1
-            club_league_days = 0
-
-    return club_league_weeks
-
-
-def get_club_league_status() -> bool:
+    if today is None:
+        today = datetime.now(timezone.utc)
+    today = today.replace(hour=0, minute=0, second=0, microsecond=0)
+    # Days are counted from since, at the same time of the day, until today at
+    # midnight
+    number_of_days = (today - since).days
+    if number_of_days < 0:
+        return 0
+    last_day = (since + timedelta(days=number_of_days)).date()
+    return club_league_calendar.get_number_of_weeks_between(since.date(), last_day)
+
+
+def get_reference_day(today: Union[datetime, date, None] = None) -> date:
+    """Return the UTC day the calendar functions are computed for.
+
+    Args:
+        today (datetime or date): The reference date, now by default.
+    """
+    if today is None:
+        return datetime.now(timezone.utc).date()
+    if isinstance(today, datetime):
+        if today.tzinfo is not None:
+            today = today.astimezone(timezone.utc)
+        return today.date()
+    return today
+
+
+def get_club_league_status(today: Union[datetime, date, None] = None) -> bool:
     """Get the club league status.
 
+    Args:
+        today (datetime or date): The reference date, now by default.
+
     Returns:
-        bool: True if the club league is currently in progress, False otherwise.
+        bool: True if the club league is in progress, False otherwise.
     """
-    current_weeks_number = datetime.today().isocalendar()[1]
-    today_index = datetime.today().weekday()
-    if current_weeks_number % 2 != 0 and today_index >= 2:
-        # We're in an odd week and it's wednesday or later
-        club_war_in_progress = True
-    elif current_weeks_number % 2 == 0 and today_index == 0:
-        # We are the monday of the week after the club war,
-        # so we have some time to spend the 14 tickets.
-        club_war_in_progress = True
-    else:
-        club_war_in_progress = False
-
-    return club_war_in_progress
-
-
-def get_this_weeks_number_of_available_tickets() -> int:
+    return club_league_calendar.is_running(get_reference_day(today))
+
+
+def get_this_weeks_number_of_available_tickets(
+    today: Union[datetime, date, None] = None
+) -> int:
     """Get the number of tickets available for this week.
 
+    We want to compute de playrate accurately, and counting 2 tickets spent on
+    14 while only 2 were available so far is not accurate.
+
+    Args:
+        today (datetime or date): The reference date, now by default.
+
     Returns:
         int: The number of tickets available for this week.
     """
-    club_war_in_progress = get_club_league_status()
-
-    if not club_war_in_progress:
+    day = get_reference_day(today)
+    if not get_club_league_status(day):
         return 0
+    return get_ticket_schedule(day).this_weeks_available_tickets
+
 
-    # Club league goes from day 2 (Wednesday) to day 0 (Monday) the next week.
-    # This means that the only day that has no club war going anywhere is Tuesday
-    # We want to compute de playrate accurately, and counting 2 tickets spent on
-    # 14 while only 2 were available so far is not accurate.
-    this_weeks_number_of_available_tickets = 0
-    today_index = datetime.today().weekday()
-    if today_index in range(2, 4):
-        # From wednesday to thursday, we only have 4 tickets available
-        this_weeks_number_of_available_tickets = 4
-    elif today_index in range(4, 6):
-        # From friday to saturday, we had a total of 8 tickets available
-        # over the week
-        this_weeks_number_of_available_tickets = 8
-    elif today_index == 6 or today_index == 0:
-        # From sunday to monday, we had a total 14 tickets available
-        # over the week
-        this_weeks_number_of_available_tickets = 14
-
-    return this_weeks_number_of_available_tickets
-
-
-def get_this_weeks_number_of_remaining_tickets() -> int:
+def get_this_weeks_number_of_remaining_tickets(
+    today: Union[datetime, date, None] = None
+) -> int:
     """Get the number of remaining tickets for this week.
 
+    Args:
+        today (datetime or date): The reference date, now by default.
+
     Returns:
         int: The number of remaining tickets for this week.
     """
-
-    club_league_running = get_club_league_status()
-    if not club_league_running:
+    day = get_reference_day(today)
+    if not get_club_league_status(day):
         return 0
-
-    today = datetime.now(timezone.utc).weekday()
-
-    # We are in a club league week
-    # 4 tickets on wednesday, 4 tickets on friday, 6 tickets on sunday
-    total_available_tickets = 14
-
-    if today in (2, 3):
-        # Wednesday, Thursday, Friday, Saturday
-        available_tickets = total_available_tickets
-    elif today in (4, 5):
-        # Friday, Saturday
-        # We lost the 4 tickets from wednesday
-        available_tickets = total_available_tickets - 4
-    elif today in (6, 0):
-        # Sunday, Monday
-        # We lost the 4 tickets from wednesday and the 4 tickets from friday
-        available_tickets = total_available_tickets - 8
-
-    return available_tickets
+    return get_ticket_schedule(day).this_weeks_remaining_tickets
 
 
-def get_today_number_of_remaining_tickets() -> int:
+def get_today_number_of_remaining_tickets(
+    today: Union[datetime, date, None] = None
+) -> int:
     """Return the number of available tickets for a given day.
 
-    Every other week, one has 14 tickets to spend, from wednesday to monday.
+    A normal match uses 1 ticket and a Power match uses 2 tickets. See
+    get_ticket_schedule for when tickets are granted.
 
-    A normal match uses 1 ticket and a Power match uses 2 tickets.
-
-    On wednesday, 4 tickets are granted out of 14 tickets. If they aren't used
-    before Friday, they are lost.
-    On Friday, 4 more tickets are granted. If they aren't used before Sunday, they
-    are lost.
-    On Sunday, 6 tickets are granted. If they aren't used before Tuesday, they are
-    lost.
+    Args:
+        today (datetime or date): The reference date, now by default.
 
     Returns:
         int: The number of tickets a given player has available for the day.
     """
-    club_league_running = get_club_league_status()
-    if not club_league_running:
+    day = get_reference_day(today)
+    if not get_club_league_status(day):
         return 0
+    return get_ticket_schedule(day).today_remaining_tickets
 
-    today = datetime.now(timezone.utc).weekday()
-
-    if today in (2, 3, 4, 5):
-        # Wednesday, Thursday, Friday, Saturday
-        available_tickets = 4
-    elif today in (6, 0):
-        # Sunday, Monday
-        available_tickets = 6
-    else:
-        return 0
 
-    return available_tickets
-
-
-def get_last_club_league_day_start() -> Union[datetime, None]:
+def get_last_club_league_day_start(
+    today: Union[datetime, date, None] = None
+) -> Union[datetime, None]:
     """Get the datetime of the start of the last club league day.
 
+    Args:
+        today (datetime or date): The reference date, now by default.
+
     Returns:
-        datetime: The datetime of the start of the last club league day.
+        datetime: The datetime of the start of the last club league day, in UTC.
         None is no club league is running.
     """
-    club_league_running = get_club_league_status()
-    if not club_league_running:
+    day = get_reference_day(today)
+    if not get_club_league_status(day):
         return None
+    club_league_day = get_ticket_schedule(day).club_league_day_start
+    if club_league_day is None:
+        return None
+    return datetime.combine(club_league_day, time(), tzinfo=timezone.utc)
 
-    today = datetime.now(timezone.utc)
-    today = today.replace(hour=0, minute=0, second=0, microsecond=0)
-    # 2 is wednesday's index in weekdays
-    offset = (today.weekday() - 2) % 7
-    if today.weekday() == 2:
-        offset = 0
-    last_wednesday = today - timedelta(days=offset)
-    last_friday = last_wednesday + timedelta(days=2)
-    last_sunday = last_wednesday + timedelta(days=4)
-
-    today = datetime.now(timezone.utc).weekday()
-
-    if today in (2, 3, 4, 5):
-        # Wednesday, Thursday, Friday, Saturday
-        if today in (2, 3):
-            club_league_day = last_wednesday
+
+def get_keyset_ordering(ordering: Sequence[str]) -> list:
+    """Order by the given fields, NULL values being the smallest ones.
+
+    Databases don't agree on where NULL values go, so we make it explicit for
+    the keyset filter to be the same on every backend.
+    """
+    expressions = []
+    for field in ordering:
+        if field.startswith("-"):
+            expressions.append(F(field[1:]).desc(nulls_last=True))
         else:
-            club_league_day = last_friday
-    elif today in (6, 0):
-        # Sunday, Monday
-        club_league_day = last_sunday
-    else:
-        return None
+            expressions.append(F(field).asc(nulls_first=True))
+    return expressions
+
+
+def get_keyset_filter(ordering: Sequence[str], position: Sequence) -> Q:
+    """Filter the rows coming after a position in a keyset ordering.
+
+    Keyword arguments:
+    ordering -- fields the rows are ordered by, prefixed with - when descending.
+    The last field must be unique (usually the primary key).
+    position -- values of these fields for the last row already seen
 
-    return club_league_day
+    Returns:
+    A Q object matching the rows after the position, e.g. for (a, -b, c):
+    a > a0 OR (a = a0 AND b < b0) OR (a = a0 AND b = b0 AND c > c0)
+    """
+    conditions = []
+    same_previous_fields = Q()
+    for field, value in zip(ordering, position):
+        descending = field.startswith("-")
+        field = field.lstrip("-")
+        if value is None:
+            # NULL is the smallest value, every non NULL value comes after it
+            # when ascending, none does when descending
+            after = None if descending else Q(**{f"{field}__isnull": False})
+            same = Q(**{f"{field}__isnull": True})
+        else:
+            after = Q(**{f"{field}__{'lt' if descending else 'gt'}": value})
+            if descending:
+                after |= Q(**{f"{field}__isnull": True})
+            same = Q(**{field: value})
+        if after is not None:
+            conditions.append(same_previous_fields & after)
+        same_previous_fields &= same
+
+    keyset_filter = Q(pk__in=[])
+    for condition in conditions:
+        keyset_filter |= condition
+    return keyset_filter
+
+
+def keyset_batches(
+    queryset: "QuerySet",
+    ordering: Sequence[str],
+    batch_size: int,
+    position: Union[Sequence, None] = None,
+) -> Iterator[Tuple[List[tuple], tuple]]:
+    """Yield the rows of a queryset batch by batch, using keyset pagination.
+
+    Instead of OFFSET, each batch seeks the rows after the last one of the
+    previous batch. Fetching a batch costs the same at the end of the table
+    as at the beginning, and rows that leave the queryset meanwhile (e.g.
+    they were updated) don't make us skip or repeat other rows.
+
+    Keyword arguments:
+    queryset -- the rows to iterate over
+    ordering -- fields the rows are ordered by, prefixed with - when descending.
+    The last field must be unique (usually the primary key).
+    batch_size -- maximum number of rows per batch
+    position -- values of the ordering fields to start after, to resume an
+    iteration
+
+    Yields:
+    A tuple with the batch, as a list of tuples of the ordering fields' values,
+    and the position of its last row.
+    """
+    fields = [field.lstrip("-") for field in ordering]
+    queryset = queryset.order_by(*get_keyset_ordering(ordering))
+    while True:
+        batch_queryset = queryset
+        if position is not None:
+            batch_queryset = queryset.filter(get_keyset_filter(ordering, position))
+        batch = list(batch_queryset.values_list(*fields)[:batch_size])
+        if not batch:
+            return
+        position = batch[-1]
+        yield batch, position
+
+
+# SQLite limits the number of parameters of a query, lists of values given to
+# an IN lookup are split in chunks of this size
+QUERY_CHUNK_SIZE = 999
+
+
+def chunks(items: Sequence, size: int = QUERY_CHUNK_SIZE) -> Iterator[Sequence]:
+    """Yield consecutive slices of items, of size elements at most."""
+    for start in range(0, len(items), size):
+        end = start + size
+        yield items[start:end]
+
+
+def get_shard_index(key: str, shard_count: int) -> int:
+    """Return the shard a key belongs to, out of shard_count shards.
+
+    Uses CRC32 rather than hash(), which is salted differently in each process,
+    so every worker agrees on the shard of a key.
+    """
+    return zlib.crc32(key.encode()) % shard_count
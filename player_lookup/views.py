@@ -13,15 +13,12 @@ from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 
 from . import models, serializers
-from .brawlstars_api import BrawlAPi
-from .update_services import update_club_members, update_player_profile
+from .update_services import brawl_api, update_club_members, update_player_profile
 
 if TYPE_CHECKING:  # pragma: no cover
     from django.db.models.query import QuerySet
     from player_lookup.models import Club, Player
 
-brawl_api = BrawlAPi()
-
 logger = logging.getLogger("django")
 
 